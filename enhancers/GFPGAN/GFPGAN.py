@@ -3,32 +3,69 @@ import cv2
 import onnxruntime
 import numpy as np
 
+# (x / 255 - 0.5) / 0.5 == x * (2 / 255) - 1
+INPUT_SCALE = np.float32(2 / 255.0)
+
 class GFPGAN:
-    def __init__(self, model_path="GFPGANv1.4.onnx", device='cpu'):
+    def __init__(self, model_path="GFPGANv1.4.onnx", device='cpu', dtype='fp32'):
         session_options = onnxruntime.SessionOptions()
         session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         providers = ["CPUExecutionProvider"]
         if device == 'cuda':
             providers = [("CUDAExecutionProvider", {"cudnn_conv_algo_search": "DEFAULT"}),"CPUExecutionProvider"]
+            if "TensorrtExecutionProvider" in onnxruntime.get_available_providers():
+                # engines are cached per precision, so only the first run for each dtype builds one
+                providers.insert(0, ("TensorrtExecutionProvider", {"trt_fp16_enable": dtype == 'fp16', "trt_engine_cache_enable": True, "trt_engine_cache_path": f"/app/trt_cache/{dtype}"}))
         self.session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=providers)
         self.resolution = self.session.get_inputs()[0].shape[-2:]
+        # models exported with dynamic_axes={'input': {0: 'batch'}} accept N images per run
+        self.dynamic_batch = not isinstance(self.session.get_inputs()[0].shape[0], int)
+        self.batch = None
+        # IOBinding needs the CUDA EP, which may have failed to load even with device='cuda'
+        self.io_binding = self.session.io_binding() if 'CUDAExecutionProvider' in self.session.get_providers() else None
+        self.input_ortvalue = None
 
-    def preprocess(self, img):
+    def preprocess(self, img, out=None):
         img = cv2.resize(img, self.resolution, interpolation=cv2.INTER_LINEAR)
-        img = img.astype(np.float32)[:,:,::-1] / 255.0
-        img = img.transpose((2, 0, 1))
-        img = (img - 0.5) / 0.5
-        img = np.expand_dims(img, axis=0).astype(np.float32)
-        return img
+        if out is None:
+            out = np.empty((1, 3, *self.resolution), dtype=np.float32)
+        # BGR HWC uint8 -> RGB CHW in [-1, 1], written straight into the (batch) buffer
+        np.multiply(img[:,:,::-1].transpose((2, 0, 1)), INPUT_SCALE, out=out[0], dtype=np.float32, casting='unsafe')
+        np.subtract(out, 1, out=out)
+        return out
 
     def postprocess(self, img):
-        img = (img.transpose(1,2,0).clip(-1,1) + 1) * 0.5
-        img = (img * 255)[:,:,::-1]
-        img = img.clip(0, 255).astype('uint8')
-        return img
+        # [-1, 1] -> [0, 255] in place on the model output, then RGB CHW -> BGR HWC
+        np.clip(img, -1, 1, out=img)
+        np.multiply(img, 127.5, out=img)
+        np.add(img, 127.5, out=img)
+        return img.transpose(1,2,0)[:,:,::-1].astype('uint8')
 
     def enhance(self, img):
         img = self.preprocess(img)
         output = self.session.run(None, {'input':img})[0][0]
         output = self.postprocess(output)
         return output
+
+    def run_batch(self, batch):
+        if self.io_binding is None:
+            return self.session.run(None, {'input':batch})[0]
+        # keep the input in a CUDA buffer that is reused until the batch shape changes
+        if self.input_ortvalue is None or self.input_ortvalue.shape() != list(batch.shape):
+            self.input_ortvalue = onnxruntime.OrtValue.ortvalue_from_shape_and_type(batch.shape, batch.dtype.type, 'cuda', 0)
+            self.io_binding.bind_ortvalue_input('input', self.input_ortvalue)
+        self.input_ortvalue.update_inplace(batch)
+        self.io_binding.bind_output(self.session.get_outputs()[0].name, 'cuda')
+        self.session.run_with_iobinding(self.io_binding)
+        return self.io_binding.copy_outputs_to_cpu()[0]
+
+    def enhance_batch(self, imgs):
+        if not self.dynamic_batch:
+            return [self.enhance(img) for img in imgs]
+        if self.batch is None or len(self.batch) < len(imgs):
+            self.batch = np.empty((len(imgs), 3, *self.resolution), dtype=np.float32)
+        batch = self.batch[:len(imgs)]
+        for i, img in enumerate(imgs):
+            self.preprocess(img, out=batch[i:i+1])
+        outputs = self.run_batch(batch)
+        return [self.postprocess(output) for output in outputs]
@@ -3,27 +3,52 @@
 import onnxruntime
 import numpy as np
 
+INV_255 = np.float32(1 / 255.0)
+
 
 class RealESRGAN_ONNX:
-    def __init__(self, model_path="RealESRGAN_x2.onnx", device='cuda'):
+    def __init__(self, model_path="RealESRGAN_x2.onnx", device='cuda', dtype='fp32'):
         session_options = onnxruntime.SessionOptions()
         session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         providers = ["CPUExecutionProvider"]
         if device == 'cuda':
             providers = [("CUDAExecutionProvider", {"cudnn_conv_algo_search": "DEFAULT"}),"CPUExecutionProvider"]
+            if "TensorrtExecutionProvider" in onnxruntime.get_available_providers():
+                # engines are cached per precision, so only the first run for each dtype builds one
+                providers.insert(0, ("TensorrtExecutionProvider", {"trt_fp16_enable": dtype == 'fp16', "trt_engine_cache_enable": True, "trt_engine_cache_path": f"/app/trt_cache/{dtype}"}))
         self.session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=providers)
+        # models exported with dynamic_axes={'input': {0: 'batch'}} accept N images per run
+        self.dynamic_batch = not isinstance(self.session.get_inputs()[0].shape[0], int)
+        self.batch = None
         
     def enhance(self, img):
         h, w = img.shape[:2] 
         #img = cv2.resize(img,(w//2, h//2), interpolation=cv2.INTER_AREA)
-        img = img.astype(np.float32)
-        img = img.transpose((2, 0, 1))
-        img = img /255
-        img = np.expand_dims(img, axis=0).astype(np.float32)
+        # uint8 HWC -> float32 CHW in [0, 1] in one pass, no intermediate copies
+        img = np.multiply(img.transpose((2, 0, 1))[None], INV_255, dtype=np.float32)
         #
         result = self.session.run(None, {(self.session.get_inputs()[0].name):img})[0][0]
         #
-        result = (result.squeeze().transpose((1,2,0)) * 255).clip(0, 255).astype(np.uint8)
-        return result
+        return self.postprocess(result)
+
+    def postprocess(self, result):
+        # scale and clip in place on the model output before the uint8 cast
+        np.multiply(result, 255, out=result)
+        np.clip(result, 0, 255, out=result)
+        return result.transpose((1,2,0)).astype(np.uint8)
+
+    def enhance_batch(self, imgs):
+        if not self.dynamic_batch:
+            return [self.enhance(img) for img in imgs]
+        h, w = imgs[0].shape[:2]
+        if self.batch is None or len(self.batch) < len(imgs) or self.batch.shape[2:] != (h, w):
+            self.batch = np.empty((len(imgs), 3, h, w), dtype=np.float32)
+        batch = self.batch[:len(imgs)]
+        for i, img in enumerate(imgs):
+            np.multiply(img.transpose((2, 0, 1)), INV_255, out=batch[i], dtype=np.float32)
+        #
+        results = self.session.run(None, {(self.session.get_inputs()[0].name):batch})[0]
+        #
+        return [self.postprocess(result) for result in results]
     
         
@@ -1,10 +1,19 @@
 import cv2
+import numpy as np
 import argparse
+import collections
+import functools
+import itertools
+import json
 import os
+import queue
+import shutil
 import subprocess
 import sys
+import threading
 from tqdm import tqdm
 import logging
+from urllib.parse import urlparse
 
 # Import các enhancers (giả sử đã có implementation)
 # from enhancers.GFPGAN.GFPGAN import GFPGANer
@@ -19,16 +28,62 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Giới hạn thread pool của OpenCV (resize, cvtColor...) để không tranh CPU với ORT và ffmpeg
+OPENCV_THREADS = 2
+cv2.setNumThreads(OPENCV_THREADS)
+
+# Model đã load, dùng lại giữa các job khi chạy trong process dài hạn (rp_handler)
+_ENHANCERS = {}
+_FACEID_MODELS = {}
+_FACE_DETECTORS = {}
+
+# Pipeline configuration
+QUEUE_SIZE = 8  # Số khung hình tối đa chờ giữa các luồng
+POLL_INTERVAL = 0.1  # Giây, để các luồng kiểm tra tín hiệu dừng
+SIGNATURE_SIZE = (128, 128)  # Kích thước ảnh thu nhỏ để so sánh khuôn mặt giữa các khung hình liên tiếp
+FACE_TRACK_DISTANCE = 0.5  # Khuôn mặt được coi là cùng một người nếu tâm lệch < 50% cạnh crop
+
+# Face detection configuration (chỉ chạy enhancer trên vùng khuôn mặt)
+FACE_DETECTOR_PATH = '/app/utils/scrfd_2.5g_bnkps.onnx'
+FACE_DETECTION_SIZE = (640, 640)
+FACE_CROP_SIZE = (512, 512)  # Kích thước input gốc của các model khuôn mặt
+FACE_CROP_PADDING = 0.5  # Khi detector không trả landmark: mở rộng bbox thêm 50% mỗi chiều để lấy cả tóc, cằm
+FACE_MASK_FEATHER = 0.05  # Độ rộng vùng làm mờ biên mask khi dán khuôn mặt, theo tỉ lệ cạnh crop
+# Vị trí 5 landmark (2 mắt, mũi, 2 khóe miệng) của khuôn mặt chuẩn FFHQ 512x512 mà các model khuôn mặt được huấn luyện
+FFHQ_TEMPLATE_512 = np.array([[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935],
+                              [201.26117, 371.41043], [313.08905, 371.15118]], dtype=np.float32)
+FACE_TEMPLATE = FFHQ_TEMPLATE_512 * np.array(FACE_CROP_SIZE, dtype=np.float32) / 512
+
+# FFmpeg encoder configuration
+FFMPEG_PIPE_BUFSIZE = 1024 * 1024  # 1MB
+FFMPEG_TIMEOUT_SECONDS = 300
+VIDEO_CODEC_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p4', '-rc', 'vbr', '-cq', '23'],
+    # CPU fallback: preset nhanh + sliced threads để dùng hết các nhân CPU
+    'libx264': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '20',
+                '-threads', '0', '-x264-params', 'threads=0:sliced-threads=1'],
+}
+# Codec audio ghi thẳng vào MP4 được (stream copy), codec khác (wmav2, pcm...) phải encode lại sang AAC
+MP4_AUDIO_CODECS = frozenset({'aac', 'mp3', 'opus', 'alac'})
+
 class MockEnhancer:
-    """Mock enhancer for testing purposes"""
+    """Mock enhancer for testing purposes
+    
+    Contract giống các enhancer thật: enhance/enhance_batch không được sửa khung hình đầu vào.
+    """
     def __init__(self, model_path, **kwargs):
         self.model_path = model_path
         logger.info(f"Initialized enhancer with model: {model_path}")
     
-    def enhance(self, frame):
+    def enhance(self, frame, w=None):
         # Placeholder enhancement - in reality this would use the actual model
         return frame
 
+    def enhance_batch(self, frames, w=None):
+        # Placeholder batch enhancement - the real enhancers stack the frames into
+        # one (N,3,H,W) float32 tensor and call session.run once per batch
+        return [self.enhance(frame, w) for frame in frames]
+
 class MockFaceID:
     """Mock FaceID for testing purposes"""
     def __init__(self, model_path):
@@ -38,10 +93,289 @@ class MockFaceID:
     def get_final_image(self, original, enhanced, reference):
         return enhanced
 
+class NVDECVideoStream:
+    """Đọc video bằng NVDEC (torchcodec), cùng interface với cv2.VideoCapture"""
+    def __init__(self, video_path):
+        try:
+            from torchcodec.decoders import VideoDecoder
+        except ImportError as e:
+            raise ImportError("Decoder nvdec cần cài torchcodec bản CUDA") from e
+        self.decoder = VideoDecoder(video_path, device="cuda")
+        self.frames = iter(self.decoder)
+    
+    def isOpened(self):
+        return True
+    
+    def read(self):
+        frame = next(self.frames, None)
+        if frame is None:
+            return False, None
+        # CUDA tensor CHW RGB -> HWC BGR trên host cho enhancer
+        return True, frame.flip(0).permute(1, 2, 0).cpu().numpy()
+    
+    def release(self):
+        self.frames = None
+        self.decoder = None
+
+class FFmpegProcess:
+    """Chạy ffmpeg nền, đọc stderr liên tục để ffmpeg không bị block khi buffer đầy"""
+    def __init__(self, cmd, **popen_kwargs):
+        self.process = subprocess.Popen(
+            cmd,
+            stderr=subprocess.PIPE,
+            bufsize=FFMPEG_PIPE_BUFSIZE,
+            **popen_kwargs
+        )
+        self.stderr_lines = collections.deque(maxlen=50)
+        self.stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self.stderr_thread.start()
+    
+    def _drain_stderr(self):
+        # Chuyển tiếp ngay vào log (ffmpeg chạy với -loglevel error), chỉ giữ 50 dòng cuối cho thông báo lỗi
+        for line in self.process.stderr:
+            line = line.decode(errors='replace').rstrip()
+            logger.warning(f"[ffmpeg] {line}")
+            self.stderr_lines.append(line)
+    
+    def _error_message(self):
+        self.stderr_thread.join(timeout=5)
+        return '\n'.join(self.stderr_lines)
+    
+    def isOpened(self):
+        return self.process.poll() is None
+    
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+
+class FFmpegVideoStream(FFmpegProcess):
+    """Decode video bằng ffmpeg (đọc được URL http/https), cùng interface với cv2.VideoCapture"""
+    def __init__(self, source, width, height, audio_path=None):
+        cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostats',
+            '-i', source,
+            '-map', '0:v:0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1'
+        ]
+        if audio_path:
+            # Tách audio ra file riêng ngay khi tải, để ghép lại sau mà không phải tải video lần hai
+            cmd += ['-map', '0:a:0', '-c:a', 'copy', '-y', audio_path]
+        super().__init__(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        self.shape = (height, width, 3)
+        self.frame_size = width * height * 3
+    
+    def read(self):
+        buffer = bytearray(self.frame_size)
+        if self.process.stdout.readinto(buffer) < self.frame_size:
+            return False, None
+        return True, np.frombuffer(buffer, dtype=np.uint8).reshape(self.shape)
+    
+    def release(self):
+        """Chờ ffmpeg kết thúc (ghi xong file audio nếu có)."""
+        self.process.stdout.close()
+        self.process.wait(timeout=FFMPEG_TIMEOUT_SECONDS)
+        if self.process.returncode != 0:
+            raise IOError(f"FFmpeg decode error (exit code {self.process.returncode}): {self._error_message()}")
+
+def audio_codec_args(audio_codec):
+    """Tham số ffmpeg cho audio khi ghi ra MP4: copy nếu MP4 chứa được codec này, ngược lại encode AAC."""
+    if audio_codec in MP4_AUDIO_CODECS:
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac']
+
+class FFmpegVideoWriter(FFmpegProcess):
+    """Pipe khung hình BGR vào ffmpeg: encode video và lấy âm thanh trong một lần"""
+    def __init__(self, output_path, audio_source, fps, width, height, video_codec, audio_codec=None):
+        cmd = [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-nostats',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps),
+            '-i', 'pipe:0'
+        ]
+        if audio_source:
+            cmd += ['-i', audio_source, '-map', '0:v', '-map', '1:a?', *audio_codec_args(audio_codec), '-shortest']
+        cmd += [
+            *VIDEO_CODEC_ARGS[video_codec],
+            '-pix_fmt', 'yuv420p',
+            output_path
+        ]
+        super().__init__(cmd, stdin=subprocess.PIPE)
+    
+    def write(self, frame):
+        # Ghi thẳng buffer của frame vào pipe, không tạo bản sao bytes cho mỗi frame
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        try:
+            self.process.stdin.write(memoryview(frame).cast('B'))
+        except BrokenPipeError:
+            self.process.wait()
+            raise IOError(f"FFmpeg đã dừng (exit code {self.process.returncode}): {self._error_message()}")
+    
+    def release(self):
+        """Đóng stdin và chờ ffmpeg ghi xong file output."""
+        self.process.stdin.close()
+        self.process.wait(timeout=FFMPEG_TIMEOUT_SECONDS)
+        if self.process.returncode != 0:
+            raise IOError(f"FFmpeg error (exit code {self.process.returncode}): {self._error_message()}")
+
+@functools.lru_cache(maxsize=None)
+def select_video_codec(preferred):
+    """Dùng encoder mong muốn nếu encode thử thành công, ngược lại fallback về libx264."""
+    if preferred == 'libx264':
+        return preferred
+    # h264_nvenc có thể được build sẵn trong ffmpeg nhưng không có GPU, nên encode thử vài frame
+    probe_cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+        *VIDEO_CODEC_ARGS[preferred],
+        '-f', 'null', '-'
+    ]
+    try:
+        result = subprocess.run(probe_cmd, capture_output=True, text=True, timeout=30)
+        if result.returncode == 0:
+            return preferred
+    except Exception as e:
+        logger.warning(f"Không thể kiểm tra encoder của ffmpeg: {e}")
+    logger.warning(f"FFmpeg không hỗ trợ {preferred}, dùng libx264")
+    return 'libx264'
+
+@functools.lru_cache(maxsize=None)
+def cuda_available():
+    """ONNX Runtime có CUDAExecutionProvider hay không."""
+    try:
+        import onnxruntime
+    except ImportError:
+        return False
+    return 'CUDAExecutionProvider' in onnxruntime.get_available_providers()
+
+def convert_model_fp16(model_path):
+    """Chuyển model ONNX sang FP16 một lần, lưu cạnh model gốc để các lần sau dùng lại."""
+    name, ext = os.path.splitext(model_path)
+    fp16_path = f"{name}_fp16{ext}"
+    if os.path.exists(fp16_path):
+        return fp16_path
+    
+    import onnx
+    from onnxconverter_common import float16
+    
+    logger.info(f"Đang chuyển model sang FP16: {model_path}")
+    model = float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+    # Ghi vào file tạm rồi rename để job khác không đọc phải file ghi dở
+    temp_path = f"{fp16_path}.{os.getpid()}.tmp"
+    try:
+        onnx.save(model, temp_path)
+        os.replace(temp_path, fp16_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return fp16_path
+
+def open_video_stream(video_path, decoder):
+    """Mở video để đọc bằng OpenCV (CPU) hoặc NVDEC (GPU)."""
+    if decoder == 'nvdec':
+        return NVDECVideoStream(video_path)
+    return cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+
+def is_url(path):
+    return path.startswith(('http://', 'https://'))
+
+def video_rotation(video):
+    """Góc xoay (độ, 0-359) của video stream từ ffprobe: display matrix hoặc tag rotate của ffmpeg cũ."""
+    rotation = video.get('tags', {}).get('rotate', 0)
+    for side_data in video.get('side_data_list', []):
+        if 'rotation' in side_data:
+            rotation = side_data['rotation']
+    try:
+        return int(round(float(rotation))) % 360
+    except ValueError:
+        return 0
+
+def probe_video(source):
+    """Lấy fps, kích thước, số frame (ước lượng) và codec audio (None nếu không có audio) bằng ffprobe."""
+    cmd = ['ffprobe', '-v', 'error', '-show_streams', '-show_format', '-of', 'json', source]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    if result.returncode != 0:
+        raise IOError(f"Không thể đọc thông tin video: {result.stderr.strip()}")
+    
+    info = json.loads(result.stdout)
+    streams = info.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        raise ValueError("Không tìm thấy video stream")
+    
+    num, den = video.get('avg_frame_rate', '0/0').split('/')
+    fps = float(num) / float(den) if float(den) > 0 else 0
+    width = int(video.get('width', 0))
+    height = int(video.get('height', 0))
+    if fps <= 0 or width <= 0 or height <= 0:
+        raise ValueError("Video có thông số không hợp lệ")
+    # ffmpeg tự xoay khung hình khi decode, nên video xoay ±90° ra frame có width/height đổi chỗ
+    if video_rotation(video) % 180 == 90:
+        width, height = height, width
+    
+    frame_count = int(video.get('nb_frames') or 0)
+    if frame_count <= 0:
+        duration = float(video.get('duration') or info.get('format', {}).get('duration') or 0)
+        frame_count = int(duration * fps)
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    audio_codec = audio.get('codec_name', '') if audio else None
+    return fps, width, height, frame_count, audio_codec
+
+def probe_audio_codec(source):
+    """Codec của audio stream đầu tiên, None nếu không có audio hoặc không đọc được bằng ffprobe."""
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name', '-of', 'csv=p=0', source]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    except Exception as e:
+        logger.warning(f"Không thể lấy codec audio: {e}")
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+def can_copy_audio_to_mp4(source):
+    """Thử copy một giây audio của source vào MP4 (ghi ra null) để biết có cần encode lại không."""
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostats',
+        '-i', source, '-map', '0:a:0', '-c:a', 'copy', '-t', '1',
+        '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov', '-y', os.devnull
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=60).returncode == 0
+    except Exception as e:
+        logger.warning(f"Không thể kiểm tra copy audio: {e}")
+        return False
+
+def mux_audio(video_path, audio_path, output_path, audio_codec=None):
+    """Ghép audio vào video đã encode, không encode lại video.
+    
+    Audio được stream copy nếu MP4 chứa được codec đó, ngược lại (hoặc khi copy lỗi) encode lại sang AAC.
+    """
+    audio_args = audio_codec_args(audio_codec)
+    while True:
+        cmd = [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+            '-i', video_path,
+            '-i', audio_path,
+            '-map', '0:v', '-map', '1:a',
+            '-c:v', 'copy', *audio_args,
+            '-shortest',
+            output_path
+        ]
+        mux = FFmpegProcess(cmd, stdout=subprocess.DEVNULL)
+        try:
+            mux.process.wait(timeout=FFMPEG_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            mux.abort()
+            raise
+        if mux.process.returncode == 0:
+            return
+        if audio_args[-1] != 'copy':
+            raise IOError(f"FFmpeg mux error: {mux._error_message()}")
+        logger.warning(f"Không copy được audio {audio_codec} vào MP4, encode lại sang AAC")
+        audio_args = ['-c:a', 'aac']
+
 def get_video_details(video_path):
     """Lấy thông tin fps và kích thước của video."""
     try:
-        video = cv2.VideoCapture(video_path)
+        video = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
         if not video.isOpened():
             raise IOError(f"Không thể mở video: {video_path}")
         
@@ -61,6 +395,14 @@ def get_video_details(video_path):
         logger.error(f"Lỗi khi lấy thông tin video: {e}")
         raise
 
+def intermediate_paths(outfile):
+    """File tạm (audio, video không tiếng) cạnh outfile khi video được decode thẳng từ URL.
+    
+    rp_handler dùng lại để xóa chúng khi worker bị kill giữa chừng.
+    """
+    name, ext = os.path.splitext(outfile)
+    return f"{name}_audio.mka", f"{name}_video_only{ext}"
+
 def cleanup_temp_files(*file_paths):
     """Dọn dẹp các file tạm thời"""
     for file_path in file_paths:
@@ -71,157 +413,570 @@ def cleanup_temp_files(*file_paths):
         except Exception as e:
             logger.warning(f"Không thể xóa file {file_path}: {e}")
 
-def main(args):
-    """Hàm chính để chạy quá trình cải thiện khuôn mặt."""
+def run_enhancer(enhancer, frames, enhancer_w=None):
+    """Gọi enhance_batch, chỉ truyền trọng số w cho enhancer có input trọng số (Codeformer)."""
+    if enhancer_w is None:
+        return enhancer.enhance_batch(frames)
+    return enhancer.enhance_batch(frames, w=enhancer_w)
+
+def bbox_affine(x1, y1, x2, y2):
+    """Affine (2x3) đưa vùng vuông quanh bbox (đã mở rộng FACE_CROP_PADDING) về FACE_CROP_SIZE."""
+    size = max(x2 - x1, y2 - y1) * (1 + FACE_CROP_PADDING)
+    scale_x, scale_y = FACE_CROP_SIZE[0] / size, FACE_CROP_SIZE[1] / size
+    cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+    return np.array([[scale_x, 0, FACE_CROP_SIZE[0] / 2 - scale_x * cx],
+                     [0, scale_y, FACE_CROP_SIZE[1] / 2 - scale_y * cy]], dtype=np.float32)
+
+def detect_faces(detector, frame, min_face_size):
+    """Trả về affine (2x3) căn chỉnh từng khuôn mặt có cạnh bbox lớn nhất >= min_face_size về FACE_TEMPLATE.
+    
+    Dùng 5 landmark của detector; nếu không có landmark hoặc không ước lượng được thì căn theo bbox.
+    """
+    det, points = detector(frame, input_size=FACE_DETECTION_SIZE)
+    affines = []
+    for i, (x1, y1, x2, y2, _) in enumerate(det):
+        if max(x2 - x1, y2 - y1) < min_face_size:
+            continue
+        affine = None
+        if points is not None:
+            affine, _ = cv2.estimateAffinePartial2D(points[i].astype(np.float32), FACE_TEMPLATE, method=cv2.LMEDS)
+        if affine is None:
+            affine = bbox_affine(x1, y1, x2, y2)
+        affines.append(affine)
+    return affines
+
+def align_face(frame, affine):
+    """Cắt khuôn mặt đã căn chỉnh kích thước FACE_CROP_SIZE; phần nằm ngoài khung hình lấy lặp lại biên."""
+    return cv2.warpAffine(frame, affine, FACE_CROP_SIZE, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+@functools.lru_cache(maxsize=None)
+def face_paste_mask(width, height):
+    """Mask float32 của crop khuôn mặt, biên mờ dần để không lộ đường viền khi dán lại (không được sửa)."""
+    feather = max(int(min(width, height) * FACE_MASK_FEATHER), 1)
+    mask = np.zeros((height, width), dtype=np.float32)
+    mask[feather:-feather, feather:-feather] = 1
+    return cv2.GaussianBlur(mask, (2 * feather + 1, 2 * feather + 1), 0)
+
+def paste_face(frame, face, affine):
+    """Warp khuôn mặt đã cải thiện về khung hình (sửa trực tiếp frame) bằng affine nghịch và mask làm mờ biên."""
+    height, width = frame.shape[:2]
+    crop_height, crop_width = face.shape[:2]
+    inverse = cv2.invertAffineTransform(affine)
+    # Chỉ warp trong hình chữ nhật bao vùng crop thay vì cả khung hình
+    corners = np.array([[0, 0], [crop_width, 0], [0, crop_height], [crop_width, crop_height]], dtype=np.float32)
+    corners = corners @ inverse[:, :2].T + inverse[:, 2]
+    x0, y0 = np.floor(corners.min(axis=0)).astype(int).clip(0, (width, height))
+    x1, y1 = np.ceil(corners.max(axis=0)).astype(int).clip(0, (width, height))
+    if x1 <= x0 or y1 <= y0:
+        return
+    inverse[:, 2] -= (x0, y0)
+    size = (int(x1 - x0), int(y1 - y0))
+    warped = cv2.warpAffine(face, inverse, size, flags=cv2.INTER_LINEAR)
+    mask = cv2.warpAffine(face_paste_mask(crop_width, crop_height), inverse, size, flags=cv2.INTER_LINEAR)[..., None]
+    region = frame[y0:y1, x0:x1]
+    region[:] = (warped * mask + region * (1 - mask) + 0.5).astype(np.uint8)
+
+def enhance_faces(enhancer, faceid_model, crops, enhancer_w=None):
+    """Cải thiện các crop khuôn mặt đã căn chỉnh (kèm FaceID nếu bật), raise nếu lỗi."""
+    enhanced_crops = run_enhancer(enhancer, crops, enhancer_w)
+    if faceid_model:
+        enhanced_crops = [
+            faceid_model.get_final_image(original, enhanced, original)
+            for original, enhanced in zip(crops, enhanced_crops)
+        ]
+    return enhanced_crops
+
+def enhance_face_regions(enhancer, faceid_model, detector, min_face_size, frames, enhancer_w=None):
+    """Chỉ chạy enhancer trên khuôn mặt đã căn chỉnh theo landmark rồi warp ngược lại vào khung hình.
+    
+    Khung hình không có khuôn mặt đủ lớn được giữ nguyên, không chạy model.
+    """
+    try:
+        faces = []  # (frame_idx, affine, crop đã căn chỉnh)
+        for i, frame in enumerate(frames):
+            for affine in detect_faces(detector, frame, min_face_size):
+                faces.append((i, affine, align_face(frame, affine)))
+        if not faces:
+            return frames, len(frames)
+        
+        enhanced_crops = enhance_faces(enhancer, faceid_model, [crop for _, _, crop in faces], enhancer_w)
+        
+        results = list(frames)
+        for (i, affine, _), enhanced in zip(faces, enhanced_crops):
+            if results[i] is frames[i]:
+                results[i] = frames[i].copy()
+            paste_face(results[i], enhanced, affine)
+        return results, len(frames)
+    
+    except Exception as e:
+        logger.error(f"Lỗi khi cải thiện khuôn mặt trong batch {len(frames)} frames: {e}")
+        return frames, 0  # Sử dụng khung hình gốc nếu có lỗi
+
+def enhance_frames(enhancer, faceid_model, frames, detector=None, min_face_size=0, enhancer_w=None):
+    """Cải thiện một batch khung hình, trả về (khung hình kết quả, số frame thành công)."""
+    if detector is not None:
+        return enhance_face_regions(enhancer, faceid_model, detector, min_face_size, frames, enhancer_w)
+    try:
+        # Enhancer không sửa khung hình đầu vào nên không cần copy để giữ bản gốc cho FaceID
+        enhanced_frames = run_enhancer(enhancer, frames, enhancer_w)
+
+        # Áp dụng FaceID nếu được bật
+        if faceid_model:
+            enhanced_frames = [
+                faceid_model.get_final_image(original, enhanced, original)
+                for original, enhanced in zip(frames, enhanced_frames)
+            ]
+
+        return enhanced_frames, len(frames)
+
+    except Exception as e:
+        logger.error(f"Lỗi khi cải thiện batch {len(frames)} frames: {e}")
+        return frames, 0  # Sử dụng khung hình gốc nếu có lỗi
+
+def queue_put(q, item, stop_event):
+    """Đưa item vào queue, trả về False nếu pipeline đã bị dừng."""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def queue_get(q, stop_event):
+    """Lấy item từ queue, trả về None nếu pipeline đã bị dừng."""
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return None
+
+def run_stage(name, target, stop_event, errors, *args):
+    """Chạy một luồng của pipeline, dừng toàn bộ pipeline nếu có lỗi."""
+    try:
+        target(*args)
+    except Exception as e:
+        logger.error(f"Lỗi trong luồng {name}: {e}")
+        errors.append(e)
+        stop_event.set()
+
+def decode_frames(video_stream, frame_count, frame_queue, stop_event):
+    """Luồng đọc: đẩy (idx, frame) vào frame_queue, kết thúc bằng None.
+    
+    frame_count=None: đọc đến hết stream (khi số frame chỉ là ước lượng).
+    """
+    frame_indices = range(frame_count) if frame_count is not None else itertools.count()
+    for frame_idx in frame_indices:
+        ret, frame = video_stream.read()
+        if not ret:
+            if frame_count is not None:
+                logger.warning(f"Không thể đọc frame {frame_idx}")
+            break
+        if not queue_put(frame_queue, (frame_idx, frame), stop_event):
+            return
+    queue_put(frame_queue, None, stop_event)
+
+def face_signature(crop):
+    """Ảnh xám thu nhỏ của khuôn mặt đã căn chỉnh để so sánh nhanh mức thay đổi giữa các khung hình."""
+    small = cv2.resize(crop, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+def face_position(affine):
+    """Tâm (x, y) và cạnh (px) trong khung hình của crop khuôn mặt ứng với affine."""
+    center = cv2.invertAffineTransform(affine) @ (FACE_CROP_SIZE[0] / 2, FACE_CROP_SIZE[1] / 2, 1)
+    size = FACE_CROP_SIZE[0] / np.sqrt(abs(np.linalg.det(affine[:, :2])))
+    return center, size
+
+def match_face(tracks, center, size):
+    """Khuôn mặt gần nhất của khung hình trước có tâm lệch < FACE_TRACK_DISTANCE * cạnh, None nếu không có."""
+    best, best_distance = None, FACE_TRACK_DISTANCE * size
+    for track in tracks:
+        distance = np.hypot(*(center - track['center']))
+        if distance < best_distance:
+            best, best_distance = track, distance
+    return best
+
+def enhance_worker(enhancer, faceid_model, detector, min_face_size, enhancer_w, batch_size, skip_threshold, skip_interval,
+                   frame_queue, result_queue, stop_event, stats):
+    """Luồng xử lý: gom batch từ frame_queue, đẩy (idx, enhanced_frame) vào result_queue.
+    
+    Nếu có detector, chỉ khuôn mặt >= min_face_size được đưa qua enhancer.
+    """
+    if detector is not None:
+        return enhance_faces_worker(enhancer, faceid_model, detector, min_face_size, enhancer_w, batch_size,
+                                    skip_threshold, skip_interval, frame_queue, result_queue, stop_event, stats)
+    batch = []  # (idx, frame)
+    while True:
+        item = queue_get(frame_queue, stop_event)
+        if item is not None:
+            batch.append(item)
+            if len(batch) < batch_size:
+                continue
+
+        # Batch đầy, hoặc batch cuối có thể chưa đầy
+        if batch:
+            frames = [frame for _, frame in batch]
+            enhanced_frames, ok_count = enhance_frames(enhancer, faceid_model, frames, enhancer_w=enhancer_w)
+            stats['processed'] += ok_count
+            for (frame_idx, _), enhanced_frame in zip(batch, enhanced_frames):
+                if not queue_put(result_queue, (frame_idx, enhanced_frame), stop_event):
+                    return
+            batch = []
+
+        if item is None:
+            queue_put(result_queue, None, stop_event)
+            return
+
+def enhance_faces_worker(enhancer, faceid_model, detector, min_face_size, enhancer_w, batch_size, skip_threshold, skip_interval,
+                         frame_queue, result_queue, stop_event, stats):
+    """Luồng xử lý theo khuôn mặt: gom batch_size crop khuôn mặt rồi chạy enhancer một lần.
+    
+    Nếu skip_threshold > 0, khuôn mặt gần như không đổi (so trên crop đã căn chỉnh) so với lần được
+    cải thiện gần nhất của cùng khuôn mặt ở khung hình trước sẽ dùng lại crop đã cải thiện đó,
+    dán bằng affine của khung hình hiện tại; tối đa skip_interval khung hình liên tiếp.
+    """
+    # Khung hình chỉ có khuôn mặt dùng lại vẫn phải chờ batch, giới hạn số khung hình giữ lại
+    max_pending = batch_size * (skip_interval + 1) if skip_threshold > 0 else batch_size
+    pending = []  # (idx, frame, [(affine, result)]), result['face'] là crop đã cải thiện sau khi chạy batch
+    crops, results = [], []  # crop chưa cải thiện và result tương ứng
+    tracks = []  # khuôn mặt của khung hình trước
+    while True:
+        item = queue_get(frame_queue, stop_event)
+        if item is not None:
+            frame_idx, frame = item
+            faces, next_tracks = [], []
+            for affine in detect_faces(detector, frame, min_face_size):
+                crop = align_face(frame, affine)
+                center, size = face_position(affine)
+                track = match_face(tracks, center, size) if skip_threshold > 0 else None
+                signature = face_signature(crop) if skip_threshold > 0 else None
+                if (track is not None and track['reuse_count'] < skip_interval
+                        and cv2.absdiff(signature, track['signature']).mean() < skip_threshold):
+                    stats['reused'] += 1
+                    result, signature, reuse_count = track['result'], track['signature'], track['reuse_count'] + 1
+                else:
+                    result, reuse_count = {}, 0
+                    crops.append(crop)
+                    results.append(result)
+                faces.append((affine, result))
+                next_tracks.append({'center': center, 'signature': signature, 'result': result, 'reuse_count': reuse_count})
+            tracks = next_tracks
+            pending.append((frame_idx, frame, faces))
+            if len(crops) < batch_size and len(pending) < max_pending:
+                continue
+
+        # Đủ batch, hoặc batch cuối có thể chưa đầy
+        if pending:
+            ok = True
+            if crops:
+                try:
+                    for result, face in zip(results, enhance_faces(enhancer, faceid_model, crops, enhancer_w)):
+                        result['face'] = face
+                except Exception as e:
+                    logger.error(f"Lỗi khi cải thiện {len(crops)} khuôn mặt: {e}")
+                    ok = False  # Giữ khuôn mặt gốc nếu có lỗi
+            for frame_idx, frame, faces in pending:
+                output = frame
+                for affine, result in faces:
+                    if 'face' not in result:
+                        continue
+                    if output is frame:
+                        output = frame.copy()
+                    paste_face(output, result['face'], affine)
+                if not queue_put(result_queue, (frame_idx, output), stop_event):
+                    return
+            if ok:
+                stats['processed'] += len(pending)
+            pending, crops, results = [], [], []
+
+        if item is None:
+            queue_put(result_queue, None, stop_event)
+            return
+
+def encode_frames(out, result_queue, stop_event, pbar):
+    """Luồng ghi: ghi khung hình theo đúng thứ tự idx."""
+    pending = {}
+    next_idx = 0
+    while True:
+        item = queue_get(result_queue, stop_event)
+        if item is None:
+            return
+        frame_idx, enhanced_frame = item
+        pending[frame_idx] = enhanced_frame
+        while next_idx in pending:
+            out.write(pending.pop(next_idx))
+            next_idx += 1
+            pbar.update(1)
+
+def enhancer_weight(args):
+    """Trọng số enhancer_w truyền vào mỗi lần gọi enhancer, None nếu model không có input trọng số."""
+    return args.enhancer_w if args.enhancer == 'Codeformer' else None
+
+def load_enhancer(args):
+    """Khởi tạo enhancer theo args, cache lại để các job sau trong cùng process dùng lại.
+    
+    Cache theo (model, dtype); enhancer_w được truyền vào từng lần gọi nên không tạo thêm session.
+    """
+    if args.enhancer == 'GFPGAN':
+        model_path = '/app/enhancers/GFPGAN/GFPGANv1.4.onnx'
+    elif args.enhancer == 'Codeformer':
+        model_path = 'enhancers/Codeformer/codeformer.onnx'
+    elif args.enhancer == 'GPEN':
+        model_path = f'enhancers/GPEN/GPEN-BFR-{args.gpen_type}.onnx'
+    elif args.enhancer == 'RealESRGAN':
+        model_path = f'enhancers/RealEsrgan/RealESRGAN_x2plus.onnx'
+    elif args.enhancer == 'Restoreformer':
+        model_path = 'enhancers/restoreformer/restoreformer.onnx'
+    elif args.enhancer == 'Restoreformer32':
+        model_path = 'enhancers/restoreformer/restoreformer32.onnx'
+    elif args.enhancer == 'Restoreformer16':
+        model_path = 'enhancers/restoreformer/restoreformer16.onnx'
+    else:
+        raise ValueError(f"Enhancer không hợp lệ: {args.enhancer}")
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Không tìm thấy model {args.enhancer}: {model_path}")
+    
+    # FP16 chỉ có lợi trên GPU, thiếu CUDA hoặc chuyển đổi lỗi thì chạy model FP32
+    dtype = 'fp32'
+    if args.dtype == 'fp16':
+        if not cuda_available():
+            logger.warning("Không có CUDAExecutionProvider, dùng model FP32")
+        else:
+            try:
+                model_path = convert_model_fp16(model_path)
+                dtype = 'fp16'
+            except Exception as e:
+                logger.warning(f"Không thể chuyển model sang FP16, dùng model FP32: {e}")
+    # dtype thực tế cũng quyết định engine TensorRT (FP16 hay FP32) của enhancer
+    key = (model_path, dtype)
+    if key not in _ENHANCERS:
+        _ENHANCERS[key] = MockEnhancer(model_path=model_path, dtype=dtype)
+    return _ENHANCERS[key]
+
+def load_faceid(args):
+    """Khởi tạo FaceID, cache lại để các job sau trong cùng process dùng lại."""
+    faceid_model_path = '/app/faceID/arcface_w600k_r50.onnx'
+    if not os.path.exists(faceid_model_path):
+        raise FileNotFoundError(f"Không tìm thấy model FaceID: {faceid_model_path}")
+    logger.info("Đang sử dụng FaceID để bảo toàn nhận dạng.")
+    if faceid_model_path not in _FACEID_MODELS:
+        _FACEID_MODELS[faceid_model_path] = MockFaceID(model_path=faceid_model_path)
+    return _FACEID_MODELS[faceid_model_path]
+
+def load_face_detector(args):
+    """Khởi tạo face detector (SCRFD), cache lại để các job sau trong cùng process dùng lại.
+    
+    Trả về None (chạy model trên toàn bộ khung hình) nếu không có model detector.
+    """
+    if not os.path.exists(FACE_DETECTOR_PATH):
+        logger.warning(f"Không tìm thấy model phát hiện khuôn mặt: {FACE_DETECTOR_PATH}, cải thiện toàn bộ khung hình")
+        return None
+    logger.info(f"Chỉ cải thiện khuôn mặt có kích thước >= {args.min_face_size}px")
+    if FACE_DETECTOR_PATH not in _FACE_DETECTORS:
+        from faceID.faceID import FaceDetection
+        _FACE_DETECTORS[FACE_DETECTOR_PATH] = FaceDetection(onnx_path=FACE_DETECTOR_PATH)
+    return _FACE_DETECTORS[FACE_DETECTOR_PATH]
+
+def warmup_models(args, runs=2):
+    """Load model theo args và chạy thử vài batch rỗng để ORT/TensorRT chọn kernel trước job đầu tiên."""
+    enhancer = load_enhancer(args)
+    faceid_model = load_faceid(args) if args.use_faceid else None
+    detector = load_face_detector(args) if args.use_faceid and args.min_face_size > 0 else None
+    frames = [np.zeros((FACE_CROP_SIZE[1], FACE_CROP_SIZE[0], 3), dtype=np.uint8)] * args.batch_size
+    for _ in range(runs):
+        run_enhancer(enhancer, frames, enhancer_weight(args))
+        if detector is not None:
+            detector(frames[0], input_size=FACE_DETECTION_SIZE)
+    if faceid_model:
+        faceid_model.get_final_image(frames[0], frames[0], frames[0])
+
+def enhance_video(args):
+    """Cải thiện khuôn mặt trong video theo args, trả về đường dẫn output, raise nếu lỗi.
+    
+    Có thể import và gọi nhiều lần trong cùng process (rp_handler): model chỉ load một lần.
+    """
     temp_files = []
+    threads = []
+    stop_event = threading.Event()
+    video_stream = None
+    out = None
     
     try:
         logger.info(f"Bắt đầu cải thiện video: {args.face}")
         
+        # Video từ URL được decode trong lúc tải, không cần tải hết về trước
+        streaming = is_url(args.face)
+        
         # Kiểm tra tệp video đầu vào
-        if not os.path.isfile(args.face):
+        if not streaming and not os.path.isfile(args.face):
             raise ValueError(f"Tệp video đầu vào không tồn tại: {args.face}")
         
         # Thiết lập đường dẫn đầu ra
         if args.outfile is None:
-            basename = os.path.basename(args.face)
+            basename = os.path.basename(urlparse(args.face).path if streaming else args.face)
             name, ext = os.path.splitext(basename)
             output_dir = "/app/outputs"
             os.makedirs(output_dir, exist_ok=True)
             args.outfile = os.path.join(output_dir, f"{name}_enhanced_{args.enhancer}{ext}")
         
-        # Thiết lập thư mục tạm
-        temp_dir = "/app/temp"
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_video_file = os.path.join(temp_dir, f"enhanced_video_no_audio_{os.getpid()}.avi")
-        temp_files.append(temp_video_file)
-        
         # Lấy thông tin video
-        fps, width, height, frame_count = get_video_details(args.face)
+        if streaming:
+            fps, width, height, frame_count, audio_codec = probe_video(args.face)
+        else:
+            fps, width, height, frame_count = get_video_details(args.face)
         logger.info(f"Video info: {width}x{height}, {fps}fps, {frame_count} frames")
         
-        # Khởi tạo enhancer
-        enhancer = None
-        if args.enhancer == 'GFPGAN':
-            model_path = '/app/enhancers/GFPGAN/GFPGANv1.4.onnx'
-            if not os.path.exists(model_path):
-                raise FileNotFoundError(f"Không tìm thấy model GFPGAN: {model_path}")
-            enhancer = MockEnhancer(model_path=model_path, upscale=args.enhancer_w)
-        elif args.enhancer == 'Codeformer':
-            enhancer = MockEnhancer(model_path='enhancers/Codeformer/codeformer.onnx', upscale=args.enhancer_w)
-        elif args.enhancer == 'GPEN':
-            enhancer = MockEnhancer(model_path=f'enhancers/GPEN/GPEN-BFR-{args.gpen_type}.onnx')
-        elif args.enhancer == 'RealESRGAN':
-            enhancer = MockEnhancer(model_path=f'enhancers/RealEsrgan/RealESRGAN_x2plus.onnx')
-        elif args.enhancer == 'Restoreformer':
-            enhancer = MockEnhancer(model_path='enhancers/restoreformer/restoreformer.onnx')
-        elif args.enhancer == 'Restoreformer32':
-            enhancer = MockEnhancer(model_path='enhancers/restoreformer/restoreformer32.onnx')
-        elif args.enhancer == 'Restoreformer16':
-            enhancer = MockEnhancer(model_path='enhancers/restoreformer/restoreformer16.onnx')
-        else:
-            raise ValueError(f"Enhancer không hợp lệ: {args.enhancer}")
+        # Khởi tạo model (dùng lại nếu đã load ở job trước)
+        enhancer = load_enhancer(args)
+        faceid_model = load_faceid(args) if args.use_faceid else None
+        # Detector đi kèm bộ model FaceID, dùng nó để bỏ qua khung hình không có khuôn mặt đủ lớn
+        detector = load_face_detector(args) if args.use_faceid and args.min_face_size > 0 else None
+        # Kết quả chỉ được dùng lại theo từng khuôn mặt nên cần detector
+        skip_threshold = args.skip_threshold
+        if skip_threshold > 0 and detector is None:
+            logger.warning("--skip_threshold cần face detector (--use_faceid và --min_face_size > 0), tắt dùng lại kết quả")
+            skip_threshold = 0
         
-        # Khởi tạo FaceID nếu được yêu cầu
-        faceid_model = None
-        if args.use_faceid:
-            faceid_model_path = '/app/faceID/arcface_w600k_r50.onnx'
-            if not os.path.exists(faceid_model_path):
-                raise FileNotFoundError(f"Không tìm thấy model FaceID: {faceid_model_path}")
-            logger.info("Đang sử dụng FaceID để bảo toàn nhận dạng.")
-            faceid_model = MockFaceID(model_path=faceid_model_path)
+        # Tạo thư mục output nếu chưa tồn tại
+        os.makedirs(os.path.dirname(args.outfile) or '.', exist_ok=True)
         
         # Mở video để đọc
-        video_stream = cv2.VideoCapture(args.face)
+        if streaming:
+            # Audio được tách ra file tạm trong lúc decode, video encode riêng rồi ghép lại bằng stream copy
+            audio_file, video_file = intermediate_paths(args.outfile)
+            if audio_codec is None:
+                audio_file = None
+            temp_files.extend(path for path in (audio_file, video_file) if path)
+            video_stream = FFmpegVideoStream(args.face, width, height, audio_file)
+        else:
+            video_stream = open_video_stream(args.face, args.decoder)
         if not video_stream.isOpened():
             raise IOError(f"Không thể mở video stream: {args.face}")
         
-        # Mở video để ghi
-        fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        out = cv2.VideoWriter(temp_video_file, fourcc, fps, (width, height))
+        # Mở ffmpeg để ghi: encode video và lấy âm thanh từ video gốc trong một lần
+        # (video từ URL chỉ encode hình, audio được ghép sau khi tải xong)
+        if streaming:
+            video_codec = select_video_codec(args.video_codec)
+            logger.info(f"Encode video bằng {video_codec}")
+            out = FFmpegVideoWriter(video_file, None, fps, width, height, video_codec)
+        elif shutil.which('ffmpeg'):
+            video_codec = select_video_codec(args.video_codec)
+            logger.info(f"Encode video bằng {video_codec}")
+            audio_codec = probe_audio_codec(args.face)
+            if audio_codec in MP4_AUDIO_CODECS and not can_copy_audio_to_mp4(args.face):
+                logger.warning(f"Không copy được audio {audio_codec} vào MP4, encode lại sang AAC")
+                audio_codec = None
+            out = FFmpegVideoWriter(args.outfile, args.face, fps, width, height, video_codec, audio_codec)
+        else:
+            # MJPG chỉ gồm I-frame nên encode nhanh hơn nhiều so với XVID trên CPU
+            logger.warning("Không tìm thấy ffmpeg, ghi video bằng OpenCV (MJPG, không có âm thanh)")
+            fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+            out = cv2.VideoWriter(args.outfile, fourcc, fps, (width, height))
         if not out.isOpened():
-            raise IOError(f"Không thể tạo video output: {temp_video_file}")
+            raise IOError(f"Không thể tạo video output: {args.outfile}")
         
-        # Xử lý từng khung hình
-        processed_frames = 0
-        for frame_idx in tqdm(range(frame_count), desc=f"Đang cải thiện bằng {args.enhancer}..."):
-            ret, frame = video_stream.read()
-            if not ret:
-                logger.warning(f"Không thể đọc frame {frame_idx}")
-                break
-            
-            # Cải thiện khung hình
-            try:
-                original_frame = frame.copy()
-                enhanced_frame = enhancer.enhance(frame)
-                
-                # Áp dụng FaceID nếu được bật
-                if faceid_model:
-                    enhanced_frame = faceid_model.get_final_image(original_frame, enhanced_frame, original_frame)
-                
-                processed_frames += 1
-                
-            except Exception as e:
-                logger.error(f"Lỗi khi cải thiện frame {frame_idx}: {e}")
-                enhanced_frame = frame  # Sử dụng khung hình gốc nếu có lỗi
-            
-            out.write(enhanced_frame)
+        # Pipeline 3 luồng: đọc -> cải thiện -> ghi, để GPU không phải chờ decode/encode
+        frame_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        result_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        errors = []
+        stats = {'processed': 0, 'reused': 0}
+        # Số frame của video từ URL chỉ là ước lượng nên đọc đến hết stream
+        read_limit = None if streaming else frame_count
+        with tqdm(total=frame_count, desc=f"Đang cải thiện bằng {args.enhancer}...") as pbar:
+            threads = [
+                threading.Thread(target=run_stage, daemon=True, args=(
+                    'decoder', decode_frames, stop_event, errors,
+                    video_stream, read_limit, frame_queue, stop_event)),
+                threading.Thread(target=run_stage, daemon=True, args=(
+                    'worker', enhance_worker, stop_event, errors,
+                    enhancer, faceid_model, detector, args.min_face_size, enhancer_weight(args), args.batch_size, skip_threshold, args.skip_interval,
+                    frame_queue, result_queue, stop_event, stats)),
+                threading.Thread(target=run_stage, daemon=True, args=(
+                    'encoder', encode_frames, stop_event, errors,
+                    out, result_queue, stop_event, pbar)),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        
+        if errors:
+            raise errors[0]
+        processed_frames = stats['processed']
+        reused_faces = stats['reused']
         
         # Giải phóng tài nguyên
         video_stream.release()
         out.release()
         
-        logger.info(f"Đã xử lý {processed_frames}/{frame_count} frames")
-        
-        # Kiểm tra file tạm có tồn tại không
-        if not os.path.exists(temp_video_file):
-            raise FileNotFoundError(f"Không tìm thấy file video tạm: {temp_video_file}")
-        
-        # Thêm âm thanh từ video gốc vào video đã cải thiện
-        logger.info("Đang thêm âm thanh vào video đã cải thiện...")
-        
-        # Tạo thư mục output nếu chưa tồn tại
-        os.makedirs(os.path.dirname(args.outfile), exist_ok=True)
-        
-        # Sử dụng ffmpeg để merge video và audio
-        ffmpeg_cmd = [
-            'ffmpeg', '-y',
-            '-i', temp_video_file,
-            '-i', args.face,
-            '-c:v', 'libx264',
-            '-c:a', 'aac',
-            '-strict', 'experimental',
-            '-shortest',
-            args.outfile
-        ]
+        logger.info(f"Đã xử lý {processed_frames}/{frame_count} frames, dùng lại kết quả cho {reused_faces} khuôn mặt")
         
-        result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=300)
-        
-        if result.returncode != 0:
-            logger.error(f"FFmpeg error: {result.stderr}")
-            # Fallback: copy temp file to output
-            import shutil
-            shutil.copy2(temp_video_file, args.outfile)
-            logger.warning("Đã copy video không có âm thanh do lỗi FFmpeg")
+        if streaming:
+            if audio_file:
+                logger.info("Đang ghép âm thanh vào video đã cải thiện...")
+                mux_audio(video_file, audio_file, args.outfile, audio_codec)
+            else:
+                os.replace(video_file, args.outfile)
         
         # Kiểm tra file output
         if not os.path.exists(args.outfile):
             raise FileNotFoundError(f"Không tạo được file output: {args.outfile}")
         
         logger.info(f"Hoàn thành! Video đã cải thiện được lưu tại: {args.outfile}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Lỗi trong quá trình xử lý: {e}")
-        return False
+        return args.outfile
     
     finally:
+        # Dừng các luồng còn chạy nếu có lỗi giữa chừng
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        if isinstance(video_stream, FFmpegVideoStream) and video_stream.isOpened():
+            video_stream.abort()
+        if out is not None and out.isOpened():
+            if isinstance(out, FFmpegVideoWriter):
+                out.abort()
+            else:
+                out.release()
+        
         # Dọn dẹp files tạm
         cleanup_temp_files(*temp_files)
 
-if __name__ == '__main__':
+def worker_loop(request_queue, result_queue, warmup_argv=None):
+    """Vòng lặp của worker process dài hạn: nhận (job_id, argv), trả về (job_id, thành công, outfile/lỗi).
+    
+    Model được load một lần (warmup_argv) và dùng lại cho mọi job, None trong queue để dừng.
+    """
+    if warmup_argv is not None:
+        try:
+            warmup_models(build_parser().parse_args(warmup_argv))
+            logger.info("Worker đã warmup model")
+        except Exception as e:
+            logger.warning(f"Warmup thất bại, model sẽ được load ở job đầu tiên: {e}")
+    while True:
+        job = request_queue.get()
+        if job is None:
+            return
+        job_id, argv = job
+        try:
+            result_queue.put((job_id, True, enhance_video(build_parser().parse_args(argv))))
+        except Exception as e:
+            logger.error(f"Lỗi trong quá trình xử lý: {e}")
+            result_queue.put((job_id, False, str(e)))
+
+def main(args):
+    """Hàm chính để chạy quá trình cải thiện khuôn mặt."""
+    try:
+        enhance_video(args)
+        return True
+    except Exception as e:
+        logger.error(f"Lỗi trong quá trình xử lý: {e}")
+        return False
+
+def build_parser():
+    """Tạo parser tham số dòng lệnh, dùng chung cho CLI và rp_handler."""
     parser = argparse.ArgumentParser(description="Cải thiện chất lượng khuôn mặt trong video bằng các mô hình AI.")
-    parser.add_argument("--face", type=str, required=True, help="Đường dẫn đến video cần cải thiện.")
+    parser.add_argument("--face", type=str, required=True, help="Đường dẫn hoặc URL http(s) của video cần cải thiện.")
     parser.add_argument("--enhancer", type=str, default="GFPGAN", 
                        choices=['GFPGAN', 'Codeformer', 'GPEN', 'RealESRGAN', 'Restoreformer', 'Restoreformer32', 'Restoreformer16'],
                        help="Chọn mô hình để cải thiện khuôn mặt.")
@@ -231,13 +986,32 @@ if __name__ == '__main__':
                        help="Chọn loại mô hình GPEN (256 hoặc 512).")
     parser.add_argument("--use_faceid", action='store_true', 
                        help="Thêm cờ này để sử dụng FaceID nhằm bảo toàn nhận dạng khuôn mặt.")
+    parser.add_argument("--min_face_size", type=int, default=64, 
+                       help="Khi dùng --use_faceid: chỉ cải thiện vùng khuôn mặt có cạnh >= giá trị này (px), bỏ qua khung hình không có khuôn mặt; 0 để chạy model trên toàn bộ khung hình.")
     parser.add_argument("--outfile", type=str, default=None, 
                        help="Đường dẫn để lưu video kết quả.")
-    
+    parser.add_argument("--batch_size", type=int, default=4, 
+                       help="Số khung hình xử lý trong một lần chạy model (4-8 tùy VRAM).")
+    parser.add_argument("--skip_threshold", type=float, default=0.0, 
+                       help="Dùng lại khuôn mặt đã cải thiện ở khung hình trước nếu chênh lệch trung bình (0-255) trên crop khuôn mặt nhỏ hơn ngưỡng này, 0 để tắt (gợi ý: 2.0). Cần --use_faceid và --min_face_size > 0.")
+    parser.add_argument("--skip_interval", type=int, default=5, 
+                       help="Số khung hình liên tiếp tối đa một khuôn mặt được dùng lại kết quả trước khi bắt buộc chạy lại model.")
+    parser.add_argument("--dtype", type=str, default="fp32", choices=['fp32', 'fp16'], 
+                       help="Kiểu số của model: fp16 chuyển model sang FP16 (lưu cache cạnh model gốc) để tăng tốc trên GPU, tự dùng fp32 nếu không có CUDA.")
+    parser.add_argument("--fp16", dest="dtype", action='store_const', const='fp16', default=argparse.SUPPRESS, 
+                       help="Tương đương --dtype fp16.")
+    parser.add_argument("--video_codec", type=str, default="h264_nvenc", choices=list(VIDEO_CODEC_ARGS), 
+                       help="Encoder video cho ffmpeg (tự động dùng libx264 nếu không có NVENC).")
+    parser.add_argument("--decoder", type=str, default="opencv", choices=['opencv', 'nvdec'], 
+                       help="Chọn decoder video: opencv (CPU) hoặc nvdec (GPU, cần torchcodec).")
+    return parser
+
+if __name__ == '__main__':
+    parser = build_parser()
     args = parser.parse_args()
     
     # Validate arguments
-    if not os.path.exists(args.face):
+    if not is_url(args.face) and not os.path.exists(args.face):
         logger.error(f"File video không tồn tại: {args.face}")
         sys.exit(1)
     
@@ -245,5 +1019,17 @@ if __name__ == '__main__':
         logger.error("enhancer_w phải trong khoảng 0-1")
         sys.exit(1)
     
+    if args.batch_size < 1:
+        logger.error("batch_size phải lớn hơn hoặc bằng 1")
+        sys.exit(1)
+    
+    if args.min_face_size < 0:
+        logger.error("min_face_size phải >= 0")
+        sys.exit(1)
+    
+    if args.skip_threshold < 0 or args.skip_interval < 1:
+        logger.error("skip_threshold phải >= 0 và skip_interval phải >= 1")
+        sys.exit(1)
+    
     success = main(args)
     sys.exit(0 if success else 1)
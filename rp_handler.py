@@ -1,89 +1,312 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
+import asyncio
+import collections
+import hashlib
 import logging
 import requests
 import tempfile
 import json
-import traceback
+import mmap
+import multiprocessing
+import queue
+import re
 from typing import Dict, Any, Optional
 import runpod
 import time
-import base64
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Configure logging
+# SIMD-accelerated base64 when available, same API as the stdlib module
+try:
+    import pybase64 as b64
+except ImportError:
+    import base64 as b64
+
+# Imported once per container so models stay loaded across jobs
+from inference_face_enhancer import build_parser, enhance_video, intermediate_paths, is_url, worker_loop
+
+# Configure logging (force: inference_face_enhancer already configured the root logger)
 logging.basicConfig(
     level=logging.INFO, 
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    force=True
 )
 logger = logging.getLogger(__name__)
 
 # Configuration
 MAX_FILE_SIZE = 500 * 1024 * 1024  # 500MB
 TIMEOUT_SECONDS = 1800  # 30 minutes
+WORKER_POLL_SECONDS = 1
+VALID_DTYPES = frozenset({'fp32', 'fp16'})
+MODEL_DTYPE = os.environ.get("MODEL_DTYPE", "fp16")  # Default model precision, the worker falls back to fp32 without CUDA
+WARMUP_ARGV = ["--face", "warmup", "--enhancer", "GFPGAN", "--use_faceid", "--dtype", MODEL_DTYPE]
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 4))  # Jobs per pod, only one uses the GPU at a time
 SUPPORTED_FORMATS = ['.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm']
+VALID_ENHANCERS = frozenset({'GFPGAN', 'Codeformer', 'GPEN', 'RealESRGAN', 'Restoreformer', 'Restoreformer32', 'Restoreformer16'})
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+DOWNLOAD_LOG_INTERVAL = 10 * 1024 * 1024  # 10MB
+DOWNLOAD_WORKERS = 8  # Parallel Range requests per download
+MIN_PARALLEL_DOWNLOAD_SIZE = 16 * 1024 * 1024  # 16MB, smaller files use a single stream
+MAX_BASE64_SIZE = 50 * 1024 * 1024  # 50MB, only used when object storage is not configured
+BASE64_READ_SIZE = 3 * 1024 * 1024  # Multiple of 3 so no padding is emitted mid-stream
+
+# Job temp files go to RAM (tmpfs) when it has room for what the job writes there
+SHM_DIR = "/dev/shm"
+OUTPUT_SIZE_FACTOR = 2  # The re-encoded output is estimated at up to twice the input size
+
+# Recent results (uploaded objects) keyed by input URL + version + enhancer params
+RESULT_CACHE_SIZE = 32
+
+# Object storage (MinIO / S3 / R2) for returning results as presigned URLs
+MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT")
+MINIO_BUCKET = os.environ.get("MINIO_BUCKET", "face-enhancer")
+MINIO_SECURE = os.environ.get("MINIO_SECURE", "true").lower() != "false"
+PRESIGNED_URL_EXPIRES = timedelta(seconds=int(os.environ.get("PRESIGNED_URL_EXPIRES", 3600)))
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_PARALLELISM = 8
+
+# Local cache of downloaded inputs, keyed by URL hash and validated by ETag/Last-Modified
+VIDEO_CACHE_DIR = os.environ.get("VIDEO_CACHE_DIR", "/app/cache")
+VIDEO_CACHE_MAX_SIZE = int(os.environ.get("VIDEO_CACHE_MAX_SIZE", 5 * 1024 * 1024 * 1024))  # 5GB
+STALE_PART_SECONDS = TIMEOUT_SECONDS  # .part files untouched for longer are left over from a killed download
+
+# Shared HTTP connection pool, sized for concurrent jobs each running parallel range downloads
+HTTP_POOL_CONNECTIONS = 16
+HTTP_POOL_MAXSIZE = 32
+HTTP_RETRIES = 3
+
+def create_http_session() -> requests.Session:
+    """Create the HTTP session reused by all downloads, so warm pods skip DNS/TCP/TLS setup"""
+    session = requests.Session()
+    retries = Retry(total=HTTP_RETRIES, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_SESSION = create_http_session()
+
+def create_storage_client():
+    """Create the object storage client once per container, or None if not configured"""
+    if not MINIO_ENDPOINT:
+        logger.info("MINIO_ENDPOINT chưa được cấu hình - kết quả sẽ trả về dạng base64")
+        return None
+    try:
+        from minio import Minio
+        return Minio(
+            MINIO_ENDPOINT,
+            access_key=os.environ.get("MINIO_ACCESS_KEY"),
+            secret_key=os.environ.get("MINIO_SECRET_KEY"),
+            secure=MINIO_SECURE
+        )
+    except Exception as e:
+        logger.warning(f"Không thể khởi tạo MinIO client, dùng base64: {e}")
+        return None
+
+storage_client = create_storage_client()
 
 class FaceEnhancerError(Exception):
     """Custom exception for face enhancer errors"""
     pass
 
-def validate_video_url(url: str) -> tuple[bool, str]:
-    """Validate video URL and return (is_valid, error_message)"""
+def full_range_size(response: requests.Response) -> Optional[int]:
+    """Total size from the Content-Range of a 206 answer to "bytes=0-", None unless the range is the whole file"""
+    match = re.fullmatch(r'bytes 0-(\d+)/(\d+)', response.headers.get('content-range', '').strip())
+    if not match or int(match[1]) != int(match[2]) - 1:
+        return None
+    total_size = int(match[2])
+    content_length = response.headers.get('content-length')
+    if content_length is not None and content_length != str(total_size):
+        return None
+    return total_size
+
+def open_video_url(url: str) -> tuple[Optional[requests.Response], str, Dict[str, Any]]:
+    """Start the streaming GET for url and validate it from the response headers
+    
+    Returns (response, error_message, url_info); response is None if the URL is invalid.
+    The body is not read yet, so the download continues on the same connection.
+    The GET asks for "bytes=0-": servers with Range support answer 206 with the true
+    total in Content-Range (even without Accept-Ranges), others send the plain 200.
+    A 206 that does not cover the whole file is dropped for a plain GET.
+    url_info holds the size, Range support and version (ETag or Last-Modified, empty
+    if the server sends neither) reported by the server.
+    """
+    response = None
     try:
         logger.info(f"Validating video URL: {url}")
         
         # Check if URL is accessible
-        response = requests.head(url, timeout=30, allow_redirects=True)
-        
-        if response.status_code != 200:
-            return False, f"URL không thể truy cập: HTTP {response.status_code}"
+        response = _SESSION.get(url, headers={'Range': 'bytes=0-'}, stream=True, timeout=60)
+        partial = response.status_code == 206
+        if partial:
+            total_size = full_range_size(response)
+            if total_size is None:
+                logger.warning(f"Server chỉ trả về một phần file (Content-Range: {response.headers.get('content-range')}), tải lại không dùng Range")
+                response.close()
+                response = _SESSION.get(url, stream=True, timeout=60)
+                partial = False
+        
+        if response.status_code != (206 if partial else 200):
+            response.close()
+            return None, f"URL không thể truy cập: HTTP {response.status_code}", {}
         
         # Check file size
-        content_length = response.headers.get('content-length')
+        content_length = str(total_size) if partial else response.headers.get('content-length')
         if content_length:
             file_size = int(content_length)
             if file_size > MAX_FILE_SIZE:
-                return False, f"File quá lớn: {file_size} bytes (max: {MAX_FILE_SIZE})"
+                response.close()
+                return None, f"File quá lớn: {file_size} bytes (max: {MAX_FILE_SIZE})", {}
         
         # Check content type
         content_type = response.headers.get('content-type', '').lower()
         if content_type and not any(vid_type in content_type for vid_type in ['video/', 'application/octet-stream']):
             logger.warning(f"Content-type có thể không phải video: {content_type}")
         
-        return True, "URL hợp lệ"
+        url_info = {
+            "size": int(content_length) if content_length else 0,
+            "accept_ranges": partial or response.headers.get('accept-ranges', '').lower() == 'bytes',
+            # Range requests need the raw bytes, a compressed transfer cannot be split
+            "encoded": bool(response.headers.get('content-encoding')),
+            "version": response.headers.get('etag') or response.headers.get('last-modified') or ""
+        }
+        return response, "URL hợp lệ", url_info
         
     except requests.exceptions.Timeout:
-        return False, "Timeout khi kiểm tra URL"
+        error_msg = "Timeout khi kiểm tra URL"
     except requests.exceptions.RequestException as e:
-        return False, f"Lỗi khi kiểm tra URL: {str(e)}"
+        error_msg = f"Lỗi khi kiểm tra URL: {str(e)}"
     except Exception as e:
-        return False, f"Lỗi không xác định: {str(e)}"
+        error_msg = f"Lỗi không xác định: {str(e)}"
+    if response is not None:
+        response.close()
+    return None, error_msg, {}
+
+class RangeNotSupportedError(FaceEnhancerError):
+    """The server ignored a Range request and sent the whole file"""
+    pass
+
+class DownloadProgress:
+    """Logs download progress every 10MB, shared by all threads of one download"""
+    def __init__(self, total_size: int, f=None):
+        self.f = f
+        self.total_size = total_size
+        self.downloaded = 0
+        self.last_logged = 0
+        self.lock = threading.Lock()
+    
+    def write(self, chunk) -> int:
+        """File-like write so shutil.copyfileobj can write through the tracker"""
+        written = self.f.write(chunk)
+        self.update(len(chunk))
+        return written
+    
+    def update(self, size: int):
+        with self.lock:
+            self.downloaded += size
+            
+            # Log progress every 10MB
+            if self.downloaded - self.last_logged >= DOWNLOAD_LOG_INTERVAL:
+                progress = (self.downloaded / self.total_size * 100) if self.total_size > 0 else 0
+                logger.info(f"Đã tải: {self.downloaded:,} bytes ({progress:.1f}%)")
+                self.last_logged = self.downloaded
 
-def download_video(url: str, output_path: str) -> bool:
-    """Download video from URL with progress tracking"""
+def preallocate(fd: int, size: int):
+    """Reserve size bytes for fd up front so the download lands in few, large extents"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        # Filesystem without fallocate support, only set the size
+        logger.debug(f"posix_fallocate không khả dụng: {e}")
+        os.ftruncate(fd, size)
+
+def download_stream(response: requests.Response, output_path: str):
+    """Download the body of an open response over its single connection"""
+    total_size = int(response.headers.get('content-length', 0))
+    
+    # Read the raw stream in 1MB blocks (still undoing any Content-Encoding)
+    response.raw.decode_content = True
+    with open(output_path, 'wb') as f:
+        # Content-Length is the encoded size, only preallocate when it matches the file
+        if total_size and not response.headers.get('content-encoding'):
+            preallocate(f.fileno(), total_size)
+        shutil.copyfileobj(response.raw, DownloadProgress(total_size, f), DOWNLOAD_CHUNK_SIZE)
+        f.truncate()
+
+def copy_range(raw, fd: int, start: int, end: int, progress: DownloadProgress):
+    """Copy bytes [start, end] from a raw response stream into fd at the same offset"""
+    offset = start
+    # pwrite takes an explicit offset, so the threads never race on a shared file position
+    while offset <= end and (chunk := raw.read(min(DOWNLOAD_CHUNK_SIZE, end + 1 - offset))):
+        os.pwrite(fd, chunk, offset)
+        offset += len(chunk)
+        progress.update(len(chunk))
+    
+    if offset != end + 1:
+        raise FaceEnhancerError(f"Tải thiếu dữ liệu ở đoạn {start}-{end}: nhận {offset - start:,} bytes")
+
+def download_range(url: str, fd: int, start: int, end: int, progress: DownloadProgress):
+    """Download bytes [start, end] of url into fd at the same offset"""
+    with _SESSION.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True, timeout=120) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeNotSupportedError(f"Server trả về HTTP {response.status_code} cho Range request")
+        copy_range(response.raw, fd, start, end, progress)
+
+def download_ranges(response: requests.Response, url: str, output_path: str, total_size: int):
+    """Download url with DOWNLOAD_WORKERS concurrent ranges into a preallocated file
+    
+    The first range is read from the already open response, the others use Range requests.
+    """
+    part_size = -(-total_size // DOWNLOAD_WORKERS)
+    ranges = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+    progress = DownloadProgress(total_size)
+    
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        preallocate(fd, total_size)
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            first_start, first_end = ranges[0]
+            futures = [executor.submit(copy_range, response.raw, fd, first_start, first_end, progress)]
+            futures += [executor.submit(download_range, url, fd, start, end, progress) for start, end in ranges[1:]]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+def download_video(url: str, output_path: str, response: requests.Response, url_info: Dict[str, Any]) -> bool:
+    """Download video from the open response with progress tracking, in parallel ranges when the server allows it"""
     try:
         logger.info(f"Bắt đầu tải video từ: {url}")
         
-        response = requests.get(url, stream=True, timeout=120)
-        response.raise_for_status()
+        total_size = url_info.get("size", 0)
+        if url_info.get("accept_ranges") and not url_info.get("encoded") and total_size >= MIN_PARALLEL_DOWNLOAD_SIZE:
+            try:
+                logger.info(f"Tải song song {DOWNLOAD_WORKERS} đoạn ({total_size:,} bytes)")
+                download_ranges(response, url, output_path, total_size)
+            except RangeNotSupportedError as e:
+                # The first response was partly consumed by the first range, start over
+                logger.warning(f"{e}, tải tuần tự")
+                response.close()
+                response = _SESSION.get(url, stream=True, timeout=120)
+                response.raise_for_status()
+                download_stream(response, output_path)
+        else:
+            download_stream(response, output_path)
         
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
-        
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    
-                    # Log progress every 10MB
-                    if downloaded % (10 * 1024 * 1024) == 0:
-                        progress = (downloaded / total_size * 100) if total_size > 0 else 0
-                        logger.info(f"Đã tải: {downloaded:,} bytes ({progress:.1f}%)")
-        
-        if os.path.getsize(output_path) == 0:
+        downloaded_size = os.path.getsize(output_path)
+        if downloaded_size == 0:
             raise FaceEnhancerError("File tải về có kích thước 0")
+        # The connection may close early without an error, compare with the size the server announced
+        if total_size and not url_info.get("encoded") and downloaded_size != total_size:
+            raise FaceEnhancerError(f"File tải về không đủ: {downloaded_size:,}/{total_size:,} bytes")
         
         logger.info(f"Tải video thành công: {os.path.getsize(output_path):,} bytes")
         return True
@@ -94,82 +317,297 @@ def download_video(url: str, output_path: str) -> bool:
     except Exception as e:
         logger.error(f"Lỗi không xác định khi tải video: {e}")
         return False
+    finally:
+        response.close()
+
+def video_cache_path(url: str) -> str:
+    """Path of the cached download for url (a sidecar .version file holds its ETag/Last-Modified)"""
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(VIDEO_CACHE_DIR, f"{key}.mp4")
+
+def is_video_cached(url: str, url_info: Dict[str, Any]) -> bool:
+    """Check whether the cached download for url is complete and still the same version as on the server"""
+    cached_path = video_cache_path(url)
+    try:
+        with open(f"{cached_path}.version") as f:
+            if f.read() != url_info["version"] or not os.path.exists(cached_path):
+                return False
+        if url_info["size"] and not url_info["encoded"] and os.path.getsize(cached_path) != url_info["size"]:
+            return False
+        # Mark as recently used for LRU eviction (atime may not be updated on noatime mounts)
+        os.utime(cached_path)
+        return True
+    except OSError:
+        return False
+
+def download_video_cached(url: str, response: requests.Response, url_info: Dict[str, Any]) -> bool:
+    """Download url into the cache, evicting least recently used entries"""
+    os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+    cached_path = video_cache_path(url)
+    partial_path = f"{cached_path}.{uuid.uuid4().hex}.part"
+    try:
+        if not download_video(url, partial_path, response, url_info):
+            return False
+        # Drop the old sidecar first so a crash in between never pairs it with the new file
+        version_path = f"{cached_path}.version"
+        cleanup_files(version_path)
+        os.replace(partial_path, cached_path)
+        with open(f"{version_path}.{uuid.uuid4().hex}.part", 'w') as f:
+            f.write(url_info["version"])
+        os.replace(f.name, version_path)
+    finally:
+        cleanup_files(partial_path)
+    evict_video_cache(keep=cached_path)
+    return True
+
+def evict_video_cache(keep: str):
+    """Delete least recently used cached videos until the cache fits in VIDEO_CACHE_MAX_SIZE
+    
+    Also removes what killed downloads leave behind: stale .part files and sidecars without their video.
+    """
+    try:
+        entries = []
+        for entry in os.scandir(VIDEO_CACHE_DIR):
+            if entry.name.endswith('.part'):
+                if time.time() - entry.stat().st_mtime > STALE_PART_SECONDS:
+                    cleanup_files(entry.path)
+            elif entry.name.endswith('.version'):
+                if not os.path.exists(entry.path[:-len('.version')]):
+                    cleanup_files(entry.path)
+            elif entry.name.endswith('.mp4') and entry.path != keep:
+                stat = entry.stat()
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries) + os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total_size <= VIDEO_CACHE_MAX_SIZE:
+                break
+            cleanup_files(path, f"{path}.version")
+            total_size -= size
+    except OSError as e:
+        logger.warning(f"Không thể dọn cache video: {e}")
+
+class EnhancerWorker:
+    """Long-lived enhancement process that keeps models loaded across jobs
+    
+    Started with 'spawn' so the child gets a clean CUDA context. A job that times out
+    or crashes the process kills it, and the next job starts a fresh one.
+    """
+    def __init__(self, warmup: bool = False):
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=worker_loop,
+            args=(self.requests, self.results, WARMUP_ARGV if warmup else None),
+            daemon=True
+        )
+        self.process.start()
+        logger.info(f"Đã khởi động enhancer worker (pid {self.process.pid})")
+    
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+    
+    def run(self, argv: list, timeout: float) -> tuple[bool, str]:
+        """Send one job to the worker and wait for its (success, outfile or error)"""
+        job_id = uuid.uuid4().hex
+        self.requests.put((job_id, argv))
+        deadline = time.time() + timeout
+        while True:
+            try:
+                result_id, success, message = self.results.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise FaceEnhancerError(f"Enhancer worker đã dừng (exit code {self.process.exitcode})")
+                if time.time() > deadline:
+                    self.terminate()
+                    raise FaceEnhancerError(f"Timeout sau {timeout}s")
+                continue
+            if result_id == job_id:
+                return success, message
+    
+    def terminate(self):
+        self.process.kill()
+        self.process.join()
+
+_WORKER: Optional[EnhancerWorker] = None
+_WORKER_START_LOCK = threading.Lock()
+# Concurrent jobs overlap their downloads and uploads, but the GPU runs one job at a time
+_GPU_LOCK = threading.Lock()
+
+def get_worker(warmup: bool = False) -> Optional[EnhancerWorker]:
+    """Return the running enhancer worker, (re)starting it if needed, or None if it cannot start"""
+    global _WORKER
+    with _WORKER_START_LOCK:
+        if _WORKER is None or not _WORKER.is_alive():
+            try:
+                _WORKER = EnhancerWorker(warmup)
+            except Exception as e:
+                logger.error(f"Không thể khởi động enhancer worker, chạy trong handler process: {e}")
+                _WORKER = None
+        return _WORKER
 
 def run_face_enhancement(input_path: str, output_path: str, 
                         enhancer: str = "GFPGAN", 
                         use_faceid: bool = True, 
-                        enhancer_w: float = 0.5) -> tuple[bool, str]:
-    """Run face enhancement with detailed logging"""
+                        enhancer_w: float = 0.5,
+                        dtype: str = MODEL_DTYPE) -> tuple[bool, str]:
+    """Run face enhancement in the long-lived worker, reusing models loaded by previous jobs"""
     try:
         logger.info(f"Bắt đầu cải thiện khuôn mặt với {enhancer}")
         
-        # Validate input file
-        if not os.path.exists(input_path):
+        # Validate input file (URLs are decoded while downloading)
+        if not is_url(input_path) and not os.path.exists(input_path):
             raise FaceEnhancerError(f"File input không tồn tại: {input_path}")
         
         # Create output directory
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        # Prepare command
-        cmd = [
-            "python", "/app/inference_face_enhancer.py",
+        # Prepare arguments
+        argv = [
             "--face", input_path,
             "--enhancer", enhancer,
             "--enhancer_w", str(enhancer_w),
+            "--dtype", dtype,
             "--outfile", output_path
         ]
         
         if use_faceid:
-            cmd.append("--use_faceid")
-        
-        logger.info(f"Chạy lệnh: {' '.join(cmd)}")
-        
-        # Run with timeout
-        start_time = time.time()
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd="/app"
-        )
+            argv.append("--use_faceid")
         
-        try:
-            stdout, stderr = process.communicate(timeout=TIMEOUT_SECONDS)
-            end_time = time.time()
-            
-            if process.returncode == 0:
-                logger.info(f"Cải thiện khuôn mặt thành công trong {end_time - start_time:.2f}s")
-                
-                # Verify output file
-                if not os.path.exists(output_path):
-                    raise FaceEnhancerError(f"File output không được tạo: {output_path}")
-                
-                output_size = os.path.getsize(output_path)
-                if output_size == 0:
-                    raise FaceEnhancerError("File output có kích thước 0")
-                
-                logger.info(f"File output: {output_size:,} bytes")
-                return True, "Thành công"
-                
+        logger.info(f"Chạy enhance_video với tham số: {' '.join(argv)}")
+        
+        with _GPU_LOCK:
+            start_time = time.time()
+            worker = get_worker()
+            if worker is not None:
+                success, message = worker.run(argv, TIMEOUT_SECONDS)
+                if not success:
+                    raise FaceEnhancerError(message)
             else:
-                error_msg = f"Lỗi inference (exit code {process.returncode}): {stderr}"
-                logger.error(error_msg)
-                return False, error_msg
-                
-        except subprocess.TimeoutExpired:
-            process.kill()
-            process.wait()
-            error_msg = f"Timeout sau {TIMEOUT_SECONDS}s"
-            logger.error(error_msg)
-            return False, error_msg
+                enhance_video(build_parser().parse_args(argv))
+            end_time = time.time()
+        
+        logger.info(f"Cải thiện khuôn mặt thành công trong {end_time - start_time:.2f}s")
+        
+        # Verify output file
+        if not os.path.exists(output_path):
+            raise FaceEnhancerError(f"File output không được tạo: {output_path}")
+        
+        output_size = os.path.getsize(output_path)
+        if output_size == 0:
+            raise FaceEnhancerError("File output có kích thước 0")
+        
+        logger.info(f"File output: {output_size:,} bytes")
+        return True, "Thành công"
             
     except Exception as e:
         error_msg = f"Lỗi trong quá trình cải thiện: {str(e)}"
-        logger.error(error_msg)
-        logger.error(traceback.format_exc())
+        logger.exception(error_msg)
         return False, error_msg
 
+def upload_result(output_path: str, job_id: str) -> str:
+    """Upload the result video and return its object name"""
+    object_name = f"results/{job_id}-{uuid.uuid4().hex}.mp4"
+    storage_client.fput_object(
+        MINIO_BUCKET, object_name, output_path,
+        content_type="video/mp4",
+        part_size=UPLOAD_PART_SIZE,
+        num_parallel_uploads=UPLOAD_PARALLELISM
+    )
+    logger.info(f"Đã upload kết quả: {MINIO_BUCKET}/{object_name}")
+    return object_name
+
+def presign_result(object_name: str) -> str:
+    """Return a fresh presigned download URL for an uploaded result"""
+    return storage_client.presigned_get_object(MINIO_BUCKET, object_name, expires=PRESIGNED_URL_EXPIRES)
+
+_RESULT_CACHE: collections.OrderedDict = collections.OrderedDict()
+_RESULT_CACHE_LOCK = threading.Lock()
+
+def result_cache_key(video_url: str, version: str, enhancer: str, use_faceid: bool, enhancer_w: float, dtype: str) -> str:
+    return hashlib.sha256(f"{video_url}|{version}|{enhancer}|{use_faceid}|{enhancer_w:.3f}|{dtype}".encode()).hexdigest()
+
+def get_cached_result(key: str) -> Optional[Dict[str, Any]]:
+    """Return a copy of the cached output for key, marking it as recently used"""
+    with _RESULT_CACHE_LOCK:
+        entry = _RESULT_CACHE.get(key)
+        if entry is None:
+            return None
+        _RESULT_CACHE.move_to_end(key)
+        return dict(entry)
+
+def cache_result(key: str, output_info: Dict[str, Any]):
+    """Remember an uploaded result, dropping the least recently used beyond RESULT_CACHE_SIZE"""
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[key] = {k: v for k, v in output_info.items() if k != "video_url"}
+        _RESULT_CACHE.move_to_end(key)
+        while len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+            _RESULT_CACHE.popitem(last=False)
+
+def encode_file_base64(file_path: str) -> str:
+    """Base64-encode a file chunk by chunk into one preallocated buffer
+    
+    The file is memory-mapped so chunks are encoded straight from the page cache, and the
+    raw file, its encoded bytes and the final str are never all in memory at once.
+    """
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size == 0:
+            return ""
+        buf = bytearray(((file_size + 2) // 3) * 4)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+                memoryview(mapped) as src, memoryview(buf) as dst:
+            pos = 0
+            for start in range(0, file_size, BASE64_READ_SIZE):
+                encoded = b64.b64encode(src[start:start + BASE64_READ_SIZE])
+                dst[pos:pos + len(encoded)] = encoded
+                pos += len(encoded)
+    return buf.decode('ascii')
+
+_SHM_CLAIMED = 0
+_SHM_LOCK = threading.Lock()
+
+def temp_space_needed(url_info: Dict[str, Any], input_in_temp: bool, stream_input: bool) -> int:
+    """Estimate the bytes a job writes to its temp dir
+    
+    The output is always written there. The input is counted only when it is downloaded
+    into the temp dir (not when it goes to the video cache or is streamed). Streaming also
+    writes audio and video-only intermediates, about one more output, before the final mux.
+    Unknown or compressed sizes count as MAX_FILE_SIZE.
+    """
+    known = url_info["size"] and not url_info["encoded"]
+    input_size = url_info["size"] if known else MAX_FILE_SIZE
+    output_size = min(OUTPUT_SIZE_FACTOR * input_size, MAX_FILE_SIZE) if known else MAX_FILE_SIZE
+    needed = output_size
+    if input_in_temp:
+        needed += input_size
+    if stream_input:
+        needed += output_size
+    return needed
+
+def claim_temp_dir(size: int) -> tuple[str, int]:
+    """Pick the temp dir for a job's files: tmpfs if it has room for size bytes, else the default temp dir
+    
+    Returns (temp_dir, claimed); the claimed tmpfs space is held until release_temp_dir(claimed),
+    so concurrent jobs cannot together fill RAM.
+    """
+    global _SHM_CLAIMED
+    with _SHM_LOCK:
+        try:
+            stat = os.statvfs(SHM_DIR)
+            if stat.f_bavail * stat.f_frsize - _SHM_CLAIMED >= size:
+                _SHM_CLAIMED += size
+                return SHM_DIR, size
+        except OSError:
+            pass
+    return tempfile.gettempdir(), 0
+
+def release_temp_dir(claimed: int):
+    """Give back tmpfs space claimed by claim_temp_dir once the job's temp files are deleted"""
+    global _SHM_CLAIMED
+    with _SHM_LOCK:
+        _SHM_CLAIMED -= claimed
+
 def cleanup_files(*file_paths):
     """Clean up temporary files"""
     for file_path in file_paths:
@@ -186,6 +624,9 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
     logger.info(f"Bắt đầu xử lý job {job_id}")
     
     temp_files = []
+    temp_claimed = 0
+    response = None
+    input_cleanup = None
     
     try:
         # Parse input
@@ -200,91 +641,153 @@ def handler(job: Dict[str, Any]) -> Dict[str, Any]:
         enhancer = input_data.get("enhancer", "GFPGAN")
         use_faceid = input_data.get("use_faceid", True)
         enhancer_w = float(input_data.get("enhancer_w", 0.5))
+        stream_input = bool(input_data.get("stream_input", False))
+        dtype = input_data.get("dtype", MODEL_DTYPE)
         
         # Validate parameters
-        valid_enhancers = ['GFPGAN', 'Codeformer', 'GPEN', 'RealESRGAN', 'Restoreformer', 'Restoreformer32', 'Restoreformer16']
-        if enhancer not in valid_enhancers:
-            return {"error": f"Enhancer không hợp lệ: {enhancer}. Chọn từ: {valid_enhancers}"}
+        if enhancer not in VALID_ENHANCERS:
+            return {"error": f"Enhancer không hợp lệ: {enhancer}. Chọn từ: {sorted(VALID_ENHANCERS)}"}
         
         if not (0 <= enhancer_w <= 1):
             return {"error": "enhancer_w phải trong khoảng 0-1"}
         
-        logger.info(f"Job {job_id}: video_url={video_url}, enhancer={enhancer}, use_faceid={use_faceid}, enhancer_w={enhancer_w}")
+        if dtype not in VALID_DTYPES:
+            return {"error": f"dtype không hợp lệ: {dtype}. Chọn từ: {sorted(VALID_DTYPES)}"}
+        
+        logger.info(f"Job {job_id}: video_url={video_url}, enhancer={enhancer}, use_faceid={use_faceid}, enhancer_w={enhancer_w}, dtype={dtype}, stream_input={stream_input}")
         
-        # Validate video URL
-        url_valid, url_error = validate_video_url(video_url)
-        if not url_valid:
+        # Validate video URL from the headers of the download request itself
+        response, url_error, url_info = open_video_url(video_url)
+        if response is None:
             return {"error": f"URL không hợp lệ: {url_error}"}
         
+        # Return a previous result for the same input and parameters without touching the GPU
+        result_key = None
+        if storage_client is not None and url_info["version"]:
+            result_key = result_cache_key(video_url, url_info["version"], enhancer, use_faceid, enhancer_w, dtype)
+            cached_output = get_cached_result(result_key)
+            if cached_output is not None:
+                logger.info(f"Job {job_id}: Dùng lại kết quả đã có: {cached_output['object_name']}")
+                cached_output["video_url"] = presign_result(cached_output["object_name"])
+                return {
+                    "status": "success",
+                    "message": "Cải thiện khuôn mặt thành công",
+                    "output": cached_output
+                }
+        
         # Create temporary files
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_input:
-            input_path = temp_input.name
-            temp_files.append(input_path)
+        use_cache = not stream_input and bool(url_info["version"])
+        input_in_temp = not stream_input and not use_cache
+        temp_dir, temp_claimed = claim_temp_dir(temp_space_needed(url_info, input_in_temp, stream_input))
+        if stream_input:
+            # Decode straight from the URL so enhancement starts on the first bytes
+            input_path = video_url
+        elif use_cache:
+            # Versioned URLs are downloaded into the cache and reused by later jobs
+            input_path = video_cache_path(video_url)
+        else:
+            with tempfile.NamedTemporaryFile(suffix='.mp4', dir=temp_dir, delete=False) as temp_input:
+                input_path = temp_input.name
+                temp_files.append(input_path)
         
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_output:
+        with tempfile.NamedTemporaryFile(suffix='.mp4', dir=temp_dir, delete=False) as temp_output:
             output_path = temp_output.name
             temp_files.append(output_path)
+        # Written next to the output when streaming; a killed worker cannot delete them itself
+        temp_files.extend(intermediate_paths(output_path))
         
         logger.info(f"Job {job_id}: Temp files - input: {input_path}, output: {output_path}")
         
+        # Make sure the worker is up: a restarted worker loads its models while the input downloads
+        get_worker(warmup=True)
+        
         # Step 1: Download video
-        logger.info(f"Job {job_id}: Bắt đầu tải video...")
-        if not download_video(video_url, input_path):
-            return {"error": "Không thể tải video"}
+        if stream_input:
+            # ffmpeg opens the URL itself
+            response.close()
+        elif use_cache and is_video_cached(video_url, url_info):
+            logger.info(f"Job {job_id}: Dùng video đã cache, bỏ qua bước tải")
+            response.close()
+        else:
+            logger.info(f"Job {job_id}: Bắt đầu tải video...")
+            if use_cache:
+                downloaded = download_video_cached(video_url, response, url_info)
+            else:
+                downloaded = download_video(video_url, input_path, response, url_info)
+            if not downloaded:
+                return {"error": "Không thể tải video"}
         
         # Step 2: Run face enhancement
         logger.info(f"Job {job_id}: Bắt đầu cải thiện khuôn mặt...")
-        success, message = run_face_enhancement(input_path, output_path, enhancer, use_faceid, enhancer_w)
+        success, message = run_face_enhancement(input_path, output_path, enhancer, use_faceid, enhancer_w, dtype)
         
         if not success:
             return {"error": f"Cải thiện khuôn mặt thất bại: {message}"}
         
+        # The input is done with: delete it in the background while the output is uploaded or encoded
+        if input_path in temp_files:
+            temp_files.remove(input_path)
+            input_cleanup = threading.Thread(target=cleanup_files, args=(input_path,), daemon=True)
+            input_cleanup.start()
+        
         # Step 3: Prepare output
         try:
             output_size = os.path.getsize(output_path)
             logger.info(f"Job {job_id}: File output size: {output_size:,} bytes")
             
-            # For RunPod, we typically return base64 for small files or upload to cloud storage
-            if output_size <= 50 * 1024 * 1024:  # 50MB limit for base64
-                with open(output_path, 'rb') as f:
-                    video_data = base64.b64encode(f.read()).decode('utf-8')
-                
-                result = {
-                    "status": "success",
-                    "message": "Cải thiện khuôn mặt thành công",
-                    "output": {
-                        "video_base64": video_data,
-                        "file_size": output_size,
-                        "enhancer_used": enhancer,
-                        "faceid_used": use_faceid,
-                        "enhancer_weight": enhancer_w
-                    }
-                }
-                
-                logger.info(f"Job {job_id}: Hoàn thành thành công")
-                return result
-                
+            output_info = {
+                "file_size": output_size,
+                "enhancer_used": enhancer,
+                "faceid_used": use_faceid,
+                "enhancer_weight": enhancer_w
+            }
+            
+            if storage_client is not None:
+                # Upload and return a URL: no base64 inflation, no size cap
+                output_info["object_name"] = upload_result(output_path, job_id)
+                output_info["video_url"] = presign_result(output_info["object_name"])
+                if result_key:
+                    cache_result(result_key, output_info)
+            elif output_size <= MAX_BASE64_SIZE:
+                output_info["video_base64"] = encode_file_base64(output_path)
             else:
-                # For large files, you would upload to cloud storage here
-                # and return the URL instead of base64
                 logger.warning(f"Job {job_id}: File quá lớn cho base64: {output_size:,} bytes")
                 return {
-                    "error": "File kết quả quá lớn. Cần implement cloud storage upload.",
+                    "error": "File kết quả quá lớn cho base64. Cấu hình MINIO_ENDPOINT để upload kết quả.",
                     "file_size": output_size
                 }
+            
+            logger.info(f"Job {job_id}: Hoàn thành thành công")
+            return {
+                "status": "success",
+                "message": "Cải thiện khuôn mặt thành công",
+                "output": output_info
+            }
                 
         except Exception as e:
             logger.error(f"Job {job_id}: Lỗi khi xử lý output: {e}")
             return {"error": f"Lỗi khi xử lý file kết quả: {str(e)}"}
         
     except Exception as e:
-        logger.error(f"Job {job_id}: Lỗi trong handler: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Job {job_id}: Lỗi trong handler: {e}")
         return {"error": f"Lỗi server: {str(e)}"}
     
     finally:
-        # Always cleanup temp files
+        # Always close the input connection and cleanup temp files
+        if response is not None:
+            response.close()
         cleanup_files(*temp_files)
+        if input_cleanup is not None:
+            input_cleanup.join()
+        release_temp_dir(temp_claimed)
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Let RunPod ramp up to MAX_CONCURRENT_JOBS jobs on this pod"""
+    return min(current_concurrency + 1, MAX_CONCURRENT_JOBS)
+
+async def async_handler(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Async RunPod handler: runs the blocking pipeline in a thread so the event loop stays free"""
+    return await asyncio.to_thread(handler, job)
 
 if __name__ == "__main__":
     logger.info("🚀 Khởi động Face Enhancer RunPod serverless handler...")
@@ -304,5 +807,8 @@ if __name__ == "__main__":
     except Exception as e:
         logger.error(f"❌ Error checking environment: {e}")
     
+    # Start the worker now so it loads and warms up the default enhancer before the first job
+    get_worker(warmup=True)
+    
     # Start RunPod serverless
-    runpod.serverless.start({"handler": handler})
+    runpod.serverless.start({"handler": async_handler, "concurrency_modifier": concurrency_modifier})
@@ -0,0 +1,98 @@
+import shutil
+import subprocess
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+import inference_face_enhancer as ife
+
+requires_ffmpeg = pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="ffmpeg/ffprobe not installed"
+)
+
+WIDTH, HEIGHT, FPS, FRAMES = 64, 48, 10, 10
+
+
+def make_video(path, audio_codec):
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc=size={WIDTH}x{HEIGHT}:rate={FPS}:duration=1",
+        "-f", "lavfi", "-i", "sine=frequency=440:duration=1",
+        "-c:v", "mpeg4", "-c:a", audio_codec, "-shortest", str(path),
+    ], check=True)
+
+
+def audio_codec_of(path):
+    return ife.probe_audio_codec(str(path))
+
+
+def write_frames(writer):
+    frame = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    for _ in range(FRAMES):
+        writer.write(frame)
+    writer.release()
+
+
+def test_audio_codec_args():
+    assert ife.audio_codec_args("aac") == ["-c:a", "copy"]
+    assert ife.audio_codec_args("wmav2") == ["-c:a", "aac"]
+    assert ife.audio_codec_args(None) == ["-c:a", "aac"]
+
+
+@requires_ffmpeg
+def test_writer_reencodes_wma_audio(tmp_path):
+    source = tmp_path / "input.wmv"
+    make_video(source, "wmav2")
+    assert audio_codec_of(source) == "wmav2"
+
+    output = tmp_path / "output.mp4"
+    writer = ife.FFmpegVideoWriter(str(output), str(source), FPS, WIDTH, HEIGHT, "libx264", audio_codec_of(source))
+    write_frames(writer)
+    assert audio_codec_of(output) == "aac"
+
+
+@requires_ffmpeg
+def test_writer_copies_aac_audio(tmp_path):
+    source = tmp_path / "input.mp4"
+    make_video(source, "aac")
+    assert ife.can_copy_audio_to_mp4(str(source))
+
+    output = tmp_path / "output.mp4"
+    writer = ife.FFmpegVideoWriter(str(output), str(source), FPS, WIDTH, HEIGHT, "libx264", "aac")
+    write_frames(writer)
+    assert audio_codec_of(output) == "aac"
+
+
+@requires_ffmpeg
+def test_mux_reencodes_wma_audio(tmp_path):
+    audio = tmp_path / "audio.mka"
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=1",
+        "-c:a", "wmav2", str(audio),
+    ], check=True)
+    video = tmp_path / "video.mp4"
+    writer = ife.FFmpegVideoWriter(str(video), None, FPS, WIDTH, HEIGHT, "libx264")
+    write_frames(writer)
+
+    output = tmp_path / "output.mp4"
+    ife.mux_audio(str(video), str(audio), str(output), "wmav2")
+    assert audio_codec_of(output) == "aac"
+
+
+@requires_ffmpeg
+def test_mux_falls_back_when_copy_fails(tmp_path):
+    # The caller reports aac but the stream is wmav2: the copy fails and the mux retries with AAC
+    audio = tmp_path / "audio.mka"
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=1",
+        "-c:a", "wmav2", str(audio),
+    ], check=True)
+    video = tmp_path / "video.mp4"
+    writer = ife.FFmpegVideoWriter(str(video), None, FPS, WIDTH, HEIGHT, "libx264")
+    write_frames(writer)
+
+    output = tmp_path / "output.mp4"
+    ife.mux_audio(str(video), str(audio), str(output), "aac")
+    assert audio_codec_of(output) == "aac"
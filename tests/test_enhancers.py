@@ -0,0 +1,69 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+onnx = pytest.importorskip("onnx")
+onnxruntime = pytest.importorskip("onnxruntime")
+from onnx import TensorProto, helper
+
+from enhancers.GFPGAN.GFPGAN import GFPGAN
+
+RESOLUTION = 32
+
+
+@pytest.fixture
+def identity_model(tmp_path):
+    """A face-enhancer-shaped model (dynamic batch, 3xHxW in and out) that returns its input"""
+    node = helper.make_node("Identity", ["input"], ["output"])
+    graph = helper.make_graph(
+        [node], "identity",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", 3, RESOLUTION, RESOLUTION])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", 3, RESOLUTION, RESOLUTION])],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    path = tmp_path / "identity.onnx"
+    onnx.save(model, str(path))
+    return str(path)
+
+
+def test_io_binding_follows_session_providers(identity_model):
+    enhancer = GFPGAN(model_path=identity_model, device="cuda")
+    if "CUDAExecutionProvider" in enhancer.session.get_providers():
+        pytest.skip("CUDA is available, the CPU fallback cannot be exercised")
+    assert enhancer.io_binding is None
+
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (RESOLUTION, RESOLUTION, 3), dtype=np.uint8) for _ in range(3)]
+    outputs = enhancer.enhance_batch(frames)
+    assert [output.shape for output in outputs] == [(RESOLUTION, RESOLUTION, 3)] * 3
+
+
+def test_batch_matches_single_frames(identity_model):
+    enhancer = GFPGAN(model_path=identity_model, device="cpu")
+    rng = np.random.default_rng(1)
+    frames = [rng.integers(0, 256, (RESOLUTION, RESOLUTION, 3), dtype=np.uint8) for _ in range(4)]
+    batched = enhancer.enhance_batch(frames)
+    for frame, output in zip(frames, batched):
+        np.testing.assert_array_equal(output, enhancer.enhance(frame))
+        # Identity model: only the [-1, 1] round trip, at most one step of rounding off
+        assert np.abs(output.astype(np.int16) - frame).max() <= 1
+
+
+@pytest.mark.parametrize("dtype", ["fp32", "fp16"])
+def test_tensorrt_precision_follows_dtype(identity_model, monkeypatch, dtype):
+    class SessionCreated(Exception):
+        pass
+
+    def fake_session(model_path, sess_options=None, providers=None):
+        raise SessionCreated(providers)
+
+    monkeypatch.setattr(onnxruntime, "get_available_providers",
+                        lambda: ["TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider"])
+    monkeypatch.setattr(onnxruntime, "InferenceSession", fake_session)
+    with pytest.raises(SessionCreated) as created:
+        GFPGAN(model_path=identity_model, device="cuda", dtype=dtype)
+    name, options = created.value.args[0][0]
+    assert name == "TensorrtExecutionProvider"
+    assert options["trt_fp16_enable"] == (dtype == "fp16")
+    assert options["trt_engine_cache_path"].endswith(dtype)
@@ -0,0 +1,131 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+import inference_face_enhancer as ife
+
+
+class FakeDetector:
+    """Trả về cố định một khuôn mặt (bbox, 5 landmark) như SCRFD."""
+
+    def __init__(self, box, points):
+        self.box = np.array([[*box, 0.9]], dtype=np.float32)
+        self.points = None if points is None else np.array([points], dtype=np.float32)
+
+    def __call__(self, img, input_size=None):
+        return self.box, self.points
+
+
+def smooth_frame(height=240, width=320):
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    return frame.astype(np.uint8)
+
+
+def face_points(scale, dx, dy):
+    """Landmark của FACE_TEMPLATE thu nhỏ theo scale rồi dịch tới (dx, dy)."""
+    return ife.FACE_TEMPLATE * scale + (dx, dy)
+
+
+def test_affine_maps_landmarks_onto_template():
+    detector = FakeDetector((90, 60, 190, 160), face_points(0.25, 80, 50))
+    [affine] = ife.detect_faces(detector, smooth_frame(), min_face_size=64)
+    mapped = detector.points[0] @ affine[:, :2].T + affine[:, 2]
+    assert np.abs(mapped - ife.FACE_TEMPLATE).max() < 1e-2
+
+
+def test_small_faces_are_skipped():
+    detector = FakeDetector((90, 60, 130, 100), face_points(0.1, 80, 50))
+    assert ife.detect_faces(detector, smooth_frame(), min_face_size=64) == []
+
+
+@pytest.mark.parametrize("points", [face_points(0.25, 80, 50), None])
+def test_identity_enhancer_leaves_frame_unchanged(points):
+    frame = smooth_frame()
+    detector = FakeDetector((90, 60, 190, 160), points)
+    [result], ok = ife.enhance_face_regions(ife.MockEnhancer("mock"), None, detector, 64, [frame])
+    assert ok == 1
+    assert result is not frame
+    assert np.abs(result.astype(int) - frame).max() <= 2
+
+
+def test_face_at_border_is_pasted_inside_frame():
+    frame = smooth_frame()
+    # Khuôn mặt lệch ra ngoài góc trên bên trái
+    detector = FakeDetector((-40, -40, 60, 60), face_points(0.25, -50, -60))
+    [affine] = ife.detect_faces(detector, frame, min_face_size=64)
+    crop = ife.align_face(frame, affine)
+    assert crop.shape == (ife.FACE_CROP_SIZE[1], ife.FACE_CROP_SIZE[0], 3)
+
+    result = frame.copy()
+    ife.paste_face(result, np.full_like(crop, 255), affine)
+    assert result.shape == frame.shape
+    assert (result[10, 10] == 255).all()
+    # Ngoài vùng khuôn mặt giữ nguyên
+    assert (result[200:, 250:] == frame[200:, 250:]).all()
+
+
+class SequenceDetector:
+    """Trả về lần lượt khuôn mặt của từng khung hình: list (dx, dy) vị trí landmark."""
+
+    def __init__(self, offsets):
+        self.offsets = iter(offsets)
+
+    def __call__(self, img, input_size=None):
+        dx, dy = next(self.offsets)
+        points = face_points(0.25, dx, dy)
+        x1, y1 = points.min(axis=0) - 30
+        x2, y2 = points.max(axis=0) + 30
+        return np.array([[x1, y1, x2, y2, 0.9]], dtype=np.float32), np.array([points], dtype=np.float32)
+
+
+class CountingEnhancer(ife.MockEnhancer):
+    def __init__(self):
+        super().__init__("mock")
+        self.faces = 0
+
+    def enhance_batch(self, frames, w=None):
+        self.faces += len(frames)
+        return [255 - frame for frame in frames]
+
+
+def run_worker(frames, offsets, skip_threshold=1.0, skip_interval=5, batch_size=2):
+    frame_queue, result_queue = ife.queue.Queue(), ife.queue.Queue()
+    for item in enumerate(frames):
+        frame_queue.put(item)
+    frame_queue.put(None)
+    enhancer = CountingEnhancer()
+    stats = {'processed': 0, 'reused': 0}
+    ife.enhance_worker(enhancer, None, SequenceDetector(offsets), 64, None, batch_size, skip_threshold, skip_interval,
+                       frame_queue, result_queue, ife.threading.Event(), stats)
+    results = {}
+    while (item := result_queue.get()) is not None:
+        results[item[0]] = item[1]
+    return enhancer, stats, [results[i] for i in range(len(frames))]
+
+
+def test_static_face_is_reused_up_to_interval():
+    frames = [smooth_frame() for _ in range(7)]
+    enhancer, stats, results = run_worker(frames, [(80, 50)] * 7, skip_interval=5)
+    assert enhancer.faces == 2
+    assert stats == {'processed': 7, 'reused': 5}
+    # Khuôn mặt dùng lại vẫn được dán vào khung hình
+    assert all((result != frame).any() for result, frame in zip(results, frames))
+
+
+def test_mouth_change_is_not_reused():
+    frames = [smooth_frame() for _ in range(2)]
+    # Miệng mở ở khung hình thứ hai: thay đổi nhỏ so với cả khung hình nhưng lớn trên crop khuôn mặt
+    frames[1][140:155, 110:140] = 255
+    enhancer, stats, _ = run_worker(frames, [(80, 50)] * 2)
+    assert enhancer.faces == 2
+    assert stats['reused'] == 0
+
+
+def test_moved_face_is_not_reused():
+    # Khung hình đồng màu: crop giống hệt nhau, chỉ vị trí khuôn mặt khác
+    frame = np.full((240, 320, 3), 128, dtype=np.uint8)
+    enhancer, stats, _ = run_worker([frame, frame], [(80, 50), (180, 50)])
+    assert enhancer.faces == 2
+    assert stats['reused'] == 0
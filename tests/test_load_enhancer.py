@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+import inference_face_enhancer as ife
+
+
+def parse(*argv):
+    return ife.build_parser().parse_args(["--face", "input.mp4", *argv])
+
+
+@pytest.fixture
+def gpen_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ife, "_ENHANCERS", {})
+    model_path = tmp_path / "enhancers" / "GPEN" / "GPEN-BFR-256.onnx"
+    model_path.parent.mkdir(parents=True)
+    model_path.touch()
+    return "enhancers/GPEN/GPEN-BFR-256.onnx"
+
+
+def test_missing_model_is_reported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        ife.load_enhancer(parse("--enhancer", "Codeformer", "--dtype", "fp16"))
+
+
+def test_fp16_falls_back_without_cuda(gpen_model, monkeypatch):
+    monkeypatch.setattr(ife, "cuda_available", lambda: False)
+    monkeypatch.setattr(ife, "convert_model_fp16", lambda path: pytest.fail("converted without CUDA"))
+    assert ife.load_enhancer(parse("--enhancer", "GPEN", "--dtype", "fp16")).model_path == gpen_model
+
+
+def test_fp16_falls_back_when_conversion_fails(gpen_model, monkeypatch):
+    def convert(path):
+        raise ImportError("No module named 'onnx'")
+    monkeypatch.setattr(ife, "cuda_available", lambda: True)
+    monkeypatch.setattr(ife, "convert_model_fp16", convert)
+    assert ife.load_enhancer(parse("--enhancer", "GPEN", "--fp16")).model_path == gpen_model
+
+
+def test_enhancer_w_reuses_cached_enhancer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ife, "_ENHANCERS", {})
+    model_path = tmp_path / "enhancers" / "Codeformer" / "codeformer.onnx"
+    model_path.parent.mkdir(parents=True)
+    model_path.touch()
+    first = ife.load_enhancer(parse("--enhancer", "Codeformer", "--dtype", "fp32", "--enhancer_w", "0.3"))
+    second = ife.load_enhancer(parse("--enhancer", "Codeformer", "--dtype", "fp32", "--enhancer_w", "0.8"))
+    assert first is second
+    assert len(ife._ENHANCERS) == 1
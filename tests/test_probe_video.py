@@ -0,0 +1,53 @@
+import shutil
+import subprocess
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+import inference_face_enhancer as ife
+
+requires_ffmpeg = pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="ffmpeg/ffprobe not installed"
+)
+
+WIDTH, HEIGHT, FPS = 64, 48, 10
+
+
+def test_video_rotation():
+    assert ife.video_rotation({}) == 0
+    assert ife.video_rotation({"tags": {"rotate": "90"}}) == 90
+    assert ife.video_rotation({"side_data_list": [{"side_data_type": "Display Matrix", "rotation": -90}]}) == 270
+    assert ife.video_rotation({"side_data_list": [{"side_data_type": "Display Matrix", "rotation": 180.0}]}) == 180
+
+
+@requires_ffmpeg
+def test_rotated_video_is_decoded_upright(tmp_path):
+    source = tmp_path / "source.mp4"
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc=size={WIDTH}x{HEIGHT}:rate={FPS}:duration=1",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p", str(source),
+    ], check=True)
+    rotated = tmp_path / "rotated.mp4"
+    result = subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-display_rotation", "90", "-i", str(source), "-c", "copy", str(rotated),
+    ])
+    if result.returncode != 0:
+        pytest.skip("ffmpeg does not support -display_rotation")
+
+    fps, width, height, frame_count, audio_codec = ife.probe_video(str(rotated))
+    assert (width, height) == (HEIGHT, WIDTH)
+    assert audio_codec is None
+
+    # ffmpeg and OpenCV both rotate on decode, so the frames must match
+    stream = ife.FFmpegVideoStream(str(rotated), width, height)
+    capture = cv2.VideoCapture(str(rotated), cv2.CAP_FFMPEG)
+    ok, frame = stream.read()
+    ok_cv, expected = capture.read()
+    capture.release()
+    stream.abort()
+    assert ok and ok_cv
+    assert frame.shape == expected.shape == (WIDTH, HEIGHT, 3)
+    assert np.abs(frame.astype(np.int16) - expected).mean() < 5
@@ -0,0 +1,132 @@
+import http.server
+import threading
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("runpod")
+pytest.importorskip("minio")
+pytest.importorskip("cv2")
+
+import rp_handler
+
+BODY = bytes(range(256)) * 40
+
+
+class VideoHandler(http.server.BaseHTTPRequestHandler):
+    """Serves BODY, answering Range requests with server.content_range and cutting the body at server.send_bytes."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get("Range"))
+        content_range = self.server.content_range
+        if self.headers.get("Range") and content_range:
+            start, end = content_range
+            body = BODY[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(BODY)}")
+        else:
+            body = BODY
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body[:self.server.send_bytes])
+        self.close_connection = True
+
+
+@pytest.fixture
+def video_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), VideoHandler)
+    server.content_range = None
+    server.send_bytes = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url_of(server):
+    return f"http://127.0.0.1:{server.server_port}/video.mp4"
+
+
+def response_with(**headers):
+    response = requests.Response()
+    response.status_code = 206
+    response.headers.update(headers)
+    return response
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"Content-Range": "bytes 0-9999/10000", "Content-Length": "10000"}, 10000),
+    ({"Content-Range": "bytes 0-9999/10000"}, 10000),
+    ({"Content-Range": "bytes 0-4999/10000", "Content-Length": "5000"}, None),
+    ({"Content-Range": "bytes 100-9999/10000"}, None),
+    ({"Content-Range": "bytes 0-9999/*"}, None),
+    ({"Content-Range": "bytes */10000"}, None),
+    ({}, None),
+])
+def test_full_range_size(headers, expected):
+    assert rp_handler.full_range_size(response_with(**headers)) == expected
+
+
+def test_full_range_size_rejects_mismatched_content_length():
+    response = response_with(**{"Content-Range": "bytes 0-9999/10000", "Content-Length": "5000"})
+    assert rp_handler.full_range_size(response) is None
+
+
+def test_full_206_is_used_as_is(video_server):
+    video_server.content_range = (0, len(BODY) - 1)
+    response, _, url_info = rp_handler.open_video_url(url_of(video_server))
+    try:
+        assert response.status_code == 206
+        assert url_info["size"] == len(BODY) and url_info["accept_ranges"]
+        assert response.raw.read() == BODY
+    finally:
+        response.close()
+    assert video_server.requests == ["bytes=0-"]
+
+
+def test_partial_206_falls_back_to_plain_get(video_server):
+    video_server.content_range = (0, len(BODY) // 2 - 1)
+    response, _, url_info = rp_handler.open_video_url(url_of(video_server))
+    try:
+        assert response.status_code == 200
+        assert url_info["size"] == len(BODY)
+        assert response.raw.read() == BODY
+    finally:
+        response.close()
+    assert video_server.requests == ["bytes=0-", None]
+
+
+def test_truncated_download_leaves_no_cache_entry(video_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(rp_handler, "VIDEO_CACHE_DIR", str(tmp_path))
+    video_server.send_bytes = len(BODY) // 3
+    url = url_of(video_server)
+    response, _, url_info = rp_handler.open_video_url(url)
+    assert url_info["size"] == len(BODY)
+
+    assert rp_handler.download_video_cached(url, response, url_info) is False
+    assert list(tmp_path.iterdir()) == []
+    assert not rp_handler.is_video_cached(url, url_info)
+
+
+MB = 1024 * 1024
+
+
+@pytest.mark.parametrize("url_info, input_in_temp, stream_input, expected", [
+    ({"size": 10 * MB, "encoded": False}, True, False, 30 * MB),   # input + output
+    ({"size": 10 * MB, "encoded": False}, False, False, 20 * MB),  # input in the video cache
+    ({"size": 10 * MB, "encoded": False}, False, True, 40 * MB),   # output + streaming intermediates
+    ({"size": 0, "encoded": False}, False, False, rp_handler.MAX_FILE_SIZE),
+    ({"size": 10 * MB, "encoded": True}, True, False, 2 * rp_handler.MAX_FILE_SIZE),
+])
+def test_temp_space_needed(url_info, input_in_temp, stream_input, expected):
+    assert rp_handler.temp_space_needed(url_info, input_in_temp, stream_input) == expected